@@ -23,6 +23,7 @@
 #-------------------------------------------------------------------------------
 
 import abc
+from xml.etree.ElementTree import Element
 
 class AvailableCommands:
     """
@@ -57,27 +58,105 @@ def add_command(self, command, help, dest):
         self.commands.append( (command, help, dest) )
 
 
-class PluginResult:
+class PluginResult(object):
     """
     Plugin.process_task() should return an instance of this class.
-    """    
-    def __init__(self, text_result, xml_result):
+    It only holds the plugin's raw results, which are cheap to send to the
+    main process. The text and XML versions of the results are only generated
+    when they are needed, using the plugin's render_txt() and render_xml().
+    """
+    __slots__ = ('plugin_class', 'command', 'argument', 'data', 'error',
+                 '_text_result', '_xml_result')
+
+    def __init__(self, plugin_class, command, argument, data=None, error=None):
         """
-        @type text_result: [str]
-        @param text_result: Printable version of the plugin's results.
-        Each string within the list gets printed as a separate line.
-        
-        @type xml_result: xml.etree.ElementTree.Element
-        @param xml_result: XML version of the plugin's results.
-        """            
-        self._text_result = text_result
-        self._xml_result = xml_result
+        @type plugin_class: PluginBase subclass
+        @param plugin_class: Plugin that generated the result.
+
+        @type command: str
+        @param command: Command that was processed.
+
+        @param argument: Argument of the command.
+
+        @type data: dict
+        @param data: The plugin's results. Should only contain types that can
+        be serialized to JSON: dict, list, str, int, float, bool and None.
+
+        @type error: str
+        @param error: Error message if the plugin raised an exception while
+        processing the command, in which case data is None.
+        """
+        self.plugin_class = plugin_class
+        self.command = command
+        self.argument = argument
+        self.data = data
+        self.error = error
+        self._text_result = None
+        self._xml_result = None
 
     def get_xml_result(self):
+        if self._xml_result is None:
+            if self.error:
+                self._xml_result = Element(self.command, exception=self.error)
+            else:
+                self._xml_result = self.plugin_class().render_xml(self)
         return self._xml_result
         
     def get_txt_result(self):  
-        return self._text_result  
+        if self._text_result is None:
+            if self.error:
+                self._text_result = ['Unhandled exception when processing --' +
+                                     self.command + ': ', self.error]
+            else:
+                self._text_result = self.plugin_class().render_txt(self)
+        return self._text_result
+
+    def get_json_result(self):
+        """
+        Returns the result as a dictionary that can be serialized to JSON.
+        """
+        return {'command' : self.command,
+                'argument' : self.argument,
+                'data' : self.data,
+                'error' : self.error}
+
+    @classmethod
+    def from_json(cls, json_result, available_commands):
+        """
+        Creates a PluginResult from a deserialized get_json_result() dict.
+
+        @type available_commands: dict
+        @param available_commands: Plugin class implementing each command.
+        """
+        json_result = _byteify(json_result)
+        return cls(available_commands[json_result['command']],
+                   json_result['command'], json_result['argument'],
+                   json_result['data'], json_result['error'])
+
+    # Rendered results are not sent across processes
+    def __getstate__(self):
+        return (self.plugin_class, self.command, self.argument, self.data,
+                self.error)
+
+    def __setstate__(self, state):
+        (self.plugin_class, self.command, self.argument, self.data,
+         self.error) = state
+        self._text_result = None
+        self._xml_result = None
+
+
+def _byteify(json_data):
+    """
+    The json module returns unicode strings; plugins work with UTF-8 str.
+    """
+    if isinstance(json_data, dict):
+        return dict([(_byteify(key), _byteify(value))
+                     for (key, value) in json_data.iteritems()])
+    elif isinstance(json_data, list):
+        return [_byteify(value) for value in json_data]
+    elif isinstance(json_data, unicode):
+        return json_data.encode('utf-8')
+    return json_data
 
 
 
@@ -94,6 +173,11 @@ class PluginBase(object):
     
     # Formatting stuff
     PLUGIN_TITLE_FORMAT = '  * {0} :'
+
+    # When all the commands for a target are processed by the same worker,
+    # plugins with a higher priority run after the others and can reuse what
+    # they learned about the target
+    PLUGIN_PRIORITY = 0
     
                               
     @classmethod
@@ -109,6 +193,37 @@ def process_task(self, target, command, args):
         This method should implement what the plugin is expected to do / test
         when given a target=(host, ip_addr, port), a command line option, and
         a command line argument. It has to be defined in each plugin class.
+        It should return a PluginResult.
+        """
+        return
+
+
+    @abc.abstractmethod
+    def render_txt(self, plugin_result):
+        """
+        This method should return the printable version of a PluginResult
+        returned by process_task(), as a list of strings. Each string gets
+        printed as a separate line.
+        It is called within the main process, only if text output is needed.
+        """
+        return
+
+
+    @abc.abstractmethod
+    def render_xml(self, plugin_result):
+        """
+        This method should return the XML version of a PluginResult returned
+        by process_task(), as an xml.etree.ElementTree.Element.
+        It is called within the main process, only if XML output is needed.
+        """
+        return
+
+
+    def teardown(self):
+        """
+        Plugin instances are reused for all the tasks a worker process gets.
+        This method is called once, when the worker process is about to exit,
+        and can be overridden to release resources kept between tasks.
         """
         return
 
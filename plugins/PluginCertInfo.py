@@ -23,17 +23,15 @@
 #   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
 #-------------------------------------------------------------------------------
 
-import os
-import sys
 import re
+from base64 import b64encode
 from xml.etree.ElementTree import Element
 
 from plugins import PluginBase
-from utils.ctSSL import ctSSL_initialize, ctSSL_cleanup, constants, \
-    X509_V_CODES, SSL_CTX
-from utils.SSLyzeSSLConnection import SSLyzeSSLConnection
+from utils.ctSSL import X509_V_CODES, X509
+from utils.HandshakeFacts import get_handshake_facts
+from utils.BoundedCache import BoundedCache
 
-TRUSTED_CA_STORE = os.path.join(sys.path[0], 'mozilla_cacert.pem')
 from mozilla_ev_oids import mozilla_EV_OIDs
 
 class X509CertificateHelper:
@@ -66,17 +64,26 @@ def parse_certificate(self):
         
 
     def parse_certificate_to_xml(self):
-        cert_dict = self.parse_certificate()
+        return self.cert_dict_to_xml(self.parse_certificate())
+
+
+    @classmethod
+    def cert_dict_to_xml(cls, cert_dict):
+        """
+        Serializes a dictionary returned by parse_certificate() to XML.
+        Doesn't need the certificate itself.
+        """
         cert_xml = []
         
         for (key, value) in cert_dict.items():
-            for xml_elem in self._keyvalue_pair_to_xml(key, value):
+            for xml_elem in cls._keyvalue_pair_to_xml(key, value):
                 cert_xml.append(xml_elem)
  
         return cert_xml
 
 
-    def _create_xml_node(self, key, value=''):
+    @classmethod
+    def _create_xml_node(cls, key, value=''):
         key = key.replace(' ', '').strip() # Remove spaces
         key = key.replace('/', '').strip() # Remove slashes (S/MIME Capabilities)
         
@@ -85,29 +92,32 @@ def _create_xml_node(self, key, value=''):
                 key = 'oid-' + key 
                 
         xml_node = Element(key)
-        xml_node.text = value.decode( "utf-8" ).strip()
+        if isinstance(value, str):
+            value = value.decode( "utf-8" )
+        xml_node.text = value.strip()
         return xml_node
     
     
-    def _keyvalue_pair_to_xml(self, key, value=''):
+    @classmethod
+    def _keyvalue_pair_to_xml(cls, key, value=''):
         res_xml = []
         
-        if type(value) is str: # value is a string
-            key_xml = self._create_xml_node(key)
+        if isinstance(value, basestring): # value is a string
+            key_xml = cls._create_xml_node(key)
             key_xml.text = value
             res_xml.append(key_xml)
             
         elif value is None: # no value
-           res_xml.append(self._create_xml_node(key))
+           res_xml.append(cls._create_xml_node(key))
            
         elif type(value) is list: # multiple strings
             for val in value:
-                res_xml.append(self._create_xml_node(key, val))
+                res_xml.append(cls._create_xml_node(key, val))
            
         elif type(value) is dict: # value is a list of subnodes
-            key_xml = self._create_xml_node(key)
+            key_xml = cls._create_xml_node(key)
             for subkey in value.keys():
-                for subxml in self._keyvalue_pair_to_xml(subkey, value[subkey]):
+                for subxml in cls._keyvalue_pair_to_xml(subkey, value[subkey]):
                     key_xml.append(subxml)
                  
             res_xml.append(key_xml)
@@ -204,17 +214,40 @@ class PluginCertInfo(PluginBase.PluginBase):
             "Mozilla's trusted root store, and prints relevant fields of "
             "the certificate. CERTINFO should be 'basic' or 'full'.",
         dest="certinfo")
+    available_commands.add_option(
+        option='keep_certificate_chain',
+        help="Option - Keeps the certificate chain sent by the server in the "
+        "results, in base64 DER, so that it can be validated again offline "
+        "with revalidate.py. Use with --json_out.",
+        dest=None)
+    available_commands.add_option(
+        option='show_certificate_chain',
+        help="Option - Also lists each certificate of the chain sent by the "
+        "server. The XML output includes each certificate in base64 DER.",
+        dest=None)
 
     FIELD_FORMAT = '      {0:<35}{1:<35}'
+
+    # Many targets share the same certificate (load balancers, wildcard
+    # certificates...). Within each process, what only depends on the
+    # certificate is kept by SHA1 fingerprint: the parsing results in the
+    # worker processes, the XML elements in the main process.
+    MAX_CACHED_CERTIFICATES = 256
+    _parsed_cert_cache = BoundedCache(MAX_CACHED_CERTIFICATES)
+    _cert_xml_cache = BoundedCache(MAX_CACHED_CERTIFICATES)
+    # Intermediate certificates are the same for even more targets; they are
+    # kept by DER
+    _chain_cert_cache = BoundedCache(MAX_CACHED_CERTIFICATES)
     
     def process_task(self, target, command, arg):
 
-        ctSSL_initialize()
-        try: # Get the certificate
-             (cert, verify_result) = self._get_cert(target)
-        except:
-            ctSSL_cleanup()
-            raise
+        if arg not in ['basic', 'full']:
+            raise Exception("PluginCertInfo: Unknown command.")
+
+        # Get the certificate from the baseline handshake
+        handshake_facts = get_handshake_facts(self._shared_settings, target)
+        cert = handshake_facts.certificate
+        verify_result = handshake_facts.verify_result
         
         # Figure out if/why the verification failed
         untrusted_reason = None
@@ -223,61 +256,154 @@ def process_task(self, target, command, arg):
             is_cert_trusted = False
             untrusted_reason = X509_V_CODES.X509_V_CODES[verify_result]
          
-        # Results formatting
-        cert_parsed = X509CertificateHelper(cert)
-        cert_dict = cert_parsed.parse_certificate()
-        
+        # Results parsing; the trust and hostname results are not cached as
+        # they depend on the chain and the target
+        data = dict(self._parse_certificate(cert))
+        data.update(
+            {'isTrustedByMozillaCAStore' : is_cert_trusted,
+             'reasonWhyNotTrusted' : untrusted_reason,
+             'hostnameValidation' : self._is_hostname_valid(data['certificate'],
+                                                            target),
+             'asText' : cert.as_text() if arg == 'full' else None})
+
+        # The chain makes each result much bigger; only send it when needed
+        if self._shared_settings['keep_certificate_chain'] \
+        or self._shared_settings['show_certificate_chain']:
+            data['certificateChain'] = [b64encode(der) for der
+                                        in handshake_facts.certificate_chain]
+
+        if self._shared_settings['show_certificate_chain']:
+            data['certificateChainInfo'] = \
+                [self._parse_chain_certificate(der) for der
+                 in handshake_facts.certificate_chain]
+
+        return PluginBase.PluginResult(self.__class__, command, arg, data)
+
+
+    def _parse_chain_certificate(self, der):
+        """
+        Returns what gets displayed about a certificate of the chain, only
+        decoding it if it wasn't seen before.
+        """
+        chain_cert = self._chain_cert_cache.get(der)
+        if chain_cert is None:
+            x509 = X509.load_der(der)
+            chain_cert = {'subject' : x509.get_subject_name().get_as_text(),
+                          'issuer' : x509.get_issuer_name().get_as_text(),
+                          'sha1Fingerprint' : x509.get_fingerprint()}
+            self._chain_cert_cache.put(der, chain_cert)
+        return chain_cert
+
+
+    def _parse_certificate(self, cert):
+        """
+        Returns the results that only depend on the certificate, parsing it
+        only if it wasn't seen before.
+        """
+        fingerprint = cert.get_fingerprint()
+        parsed_cert = self._parsed_cert_cache.get(fingerprint)
+        if parsed_cert:
+            return parsed_cert
+
+        cert_dict = X509CertificateHelper(cert).parse_certificate()
+        try:
+            alt_name_txt = cert.get_extension_list().get_extension('X509v3 Subject Alternative Name')
+        except KeyError:
+            alt_name_txt = None
+
+        parsed_cert = {'isExtendedValidation' : self._is_ev_certificate(cert_dict),
+                       'sha1Fingerprint' : fingerprint,
+                       'certificate' : cert_dict,
+                       'issuerText' : cert.get_issuer_name().get_as_text(),
+                       'subjectAltNameText' : alt_name_txt}
+        self._parsed_cert_cache.put(fingerprint, parsed_cert)
+        return parsed_cert
+
+
+    def render_txt(self, plugin_result):
+        data = plugin_result.data
+
         # Text output
-        if arg == 'basic':
-            cert_txt = self._get_basic_text(cert, cert_dict)
-        elif arg == 'full':
-            cert_txt = [cert.as_text()]
+        if plugin_result.argument == 'basic':
+            cert_txt = self._get_basic_text(data)
         else:
-            raise Exception("PluginCertInfo: Unknown command.")
+            cert_txt = [data['asText']]
             
-        fingerprint = cert.get_fingerprint()
         cmd_title = 'Certificate'
         txt_result = [self.PLUGIN_TITLE_FORMAT.format(cmd_title)]
-        trust_txt = 'Certificate is Trusted' if is_cert_trusted \
+        trust_txt = 'Certificate is Trusted' if data['isTrustedByMozillaCAStore'] \
                                              else 'Certificate is NOT Trusted'
 
-        is_ev = self._is_ev_certificate(cert_dict)
-        if is_ev:
+        if data['isExtendedValidation']:
             trust_txt = trust_txt + ' - Extended Validation'
             
-        if untrusted_reason:
-            trust_txt = trust_txt + ': ' + untrusted_reason
+        if data['reasonWhyNotTrusted']:
+            trust_txt = trust_txt + ': ' + data['reasonWhyNotTrusted']
 
         txt_result.append(self.FIELD_FORMAT.format("Validation w/ Mozilla's CA Store:", trust_txt))
         
-        is_host_valid = self._is_hostname_valid(cert_dict, target)
+        is_host_valid = data['hostnameValidation']
         host_txt = 'OK - ' + is_host_valid + ' Matches' if is_host_valid \
                                          else 'MISMATCH'
         
         txt_result.append(self.FIELD_FORMAT.format("Hostname Validation:", host_txt))
-        txt_result.append(self.FIELD_FORMAT.format('SHA1 Fingerprint:', fingerprint))
+        txt_result.append(self.FIELD_FORMAT.format('SHA1 Fingerprint:', data['sha1Fingerprint']))
         txt_result.append('')
         txt_result.extend(cert_txt)
 
+        if data.get('certificateChainInfo'):
+            txt_result.append('')
+            txt_result.append(self.FIELD_FORMAT.format('Certificate Chain:', ''))
+            for (i, chain_cert) in enumerate(data['certificateChainInfo']):
+                txt_result.append(self.FIELD_FORMAT.format(
+                    str(i) + ' - Subject:', chain_cert['subject']))
+                txt_result.append(self.FIELD_FORMAT.format(
+                    '    Issuer:', chain_cert['issuer']))
+                txt_result.append(self.FIELD_FORMAT.format(
+                    '    SHA1 Fingerprint:', chain_cert['sha1Fingerprint']))
+        return txt_result
+
+
+    def render_xml(self, plugin_result):
+        data = plugin_result.data
+
         # XML output: always return the full certificate
-        host_xml = True if is_host_valid \
+        host_xml = True if data['hostnameValidation'] \
                         else False
             
-        xml_result = Element(command, argument = arg, title = cmd_title)
-        trust_xml_attr = {'isTrustedByMozillaCAStore' : str(is_cert_trusted),
-                          'sha1Fingerprint' : fingerprint,
-                          'isExtendedValidation' : str(is_ev),
+        cmd_title = 'Certificate'
+        xml_result = Element(plugin_result.command,
+                             argument = plugin_result.argument, title = cmd_title)
+        trust_xml_attr = {'isTrustedByMozillaCAStore' : str(data['isTrustedByMozillaCAStore']),
+                          'sha1Fingerprint' : data['sha1Fingerprint'],
+                          'isExtendedValidation' : str(data['isExtendedValidation']),
                           'hasMatchingHostname' : str(host_xml)}
-        if untrusted_reason:
-            trust_xml_attr['reasonWhyNotTrusted'] = untrusted_reason
+        if data['reasonWhyNotTrusted']:
+            trust_xml_attr['reasonWhyNotTrusted'] = data['reasonWhyNotTrusted']
             
         trust_xml = Element('certificate', attrib = trust_xml_attr)
-        for elem_xml in cert_parsed.parse_certificate_to_xml():
+
+        # The elements can be shared by several targets since ElementTree
+        # doesn't keep track of parents, and they always end up at the same
+        # depth when getting indented
+        cert_xml = self._cert_xml_cache.get(data['sha1Fingerprint'])
+        if cert_xml is None:
+            cert_xml = X509CertificateHelper.cert_dict_to_xml(data['certificate'])
+            self._cert_xml_cache.put(data['sha1Fingerprint'], cert_xml)
+        for elem_xml in cert_xml:
             trust_xml.append(elem_xml)
         xml_result.append(trust_xml)
+
+        if data.get('certificateChainInfo'):
+            chain_xml = Element('certificateChain')
+            for (chain_cert, b64_der) in zip(data['certificateChainInfo'],
+                                             data['certificateChain']):
+                chain_cert_xml = Element('chainCertificate', attrib = chain_cert)
+                chain_cert_xml.text = b64_der
+                chain_xml.append(chain_cert_xml)
+            xml_result.append(chain_xml)
         
-        ctSSL_cleanup()
-        return PluginBase.PluginResult(txt_result, xml_result)
+        return xml_result
 
 
 # FORMATTING FUNCTIONS
@@ -312,21 +438,19 @@ def _is_ev_certificate(self, cert_dict):
         return False
         
     
-    def _get_basic_text(self, cert,  cert_dict):      
+    def _get_basic_text(self, data):      
+        cert_dict = data['certificate']
         basic_txt = [ \
         self.FIELD_FORMAT.format("Common Name:", cert_dict['subject']['commonName'][0] ),
-        self.FIELD_FORMAT.format("Issuer:", cert.get_issuer_name().get_as_text()),
+        self.FIELD_FORMAT.format("Issuer:", data['issuerText']),
         self.FIELD_FORMAT.format("Serial Number:", cert_dict['serialNumber']),
         self.FIELD_FORMAT.format("Not Before:", cert_dict['validity']['notBefore']),
         self.FIELD_FORMAT.format("Not After:", cert_dict['validity']['notAfter']),
         self.FIELD_FORMAT.format("Signature Algorithm:", cert_dict['signatureAlgorithm']),
         self.FIELD_FORMAT.format("Key Size:", cert_dict['subjectPublicKeyInfo']['publicKeySize'])]
         
-        try:
-            alt_name = cert.get_extension_list().get_extension('X509v3 Subject Alternative Name')
-            basic_txt.append (self.FIELD_FORMAT.format('X509v3 Subject Alternative Name:', alt_name))
-        except KeyError:
-            pass
+        if data['subjectAltNameText']:
+            basic_txt.append (self.FIELD_FORMAT.format('X509v3 Subject Alternative Name:', data['subjectAltNameText']))
         
         return basic_txt
 
@@ -339,27 +463,6 @@ def _get_fingerprint(self, cert):
         return ([val_txt], [val_xml])    
 
 
-    def _get_cert(self, target):
-        """
-        Connects to the target server and returns the server's certificate
-        """
-        verify_result = None
-        ssl_ctx = SSL_CTX.SSL_CTX('tlsv1') # sslv23 hello will fail for specific servers such as post.craigslist.org
-        ssl_ctx.load_verify_locations(TRUSTED_CA_STORE)
-        ssl_ctx.set_verify(constants.SSL_VERIFY_NONE) # We'll use get_verify_result()
-        ssl_connect = SSLyzeSSLConnection(self._shared_settings, target,ssl_ctx,
-                                          hello_workaround=True)
-
-        try: # Perform the SSL handshake
-            ssl_connect.connect()
-            cert = ssl_connect._ssl.get_peer_certificate()
-            verify_result = ssl_connect._ssl.get_verify_result()
-        finally:
-            ssl_connect.close()
-
-        return (cert, verify_result)
-
-
 def _dnsname_to_pat(dn):
     """
     Generates a regexp for the given name, to be used for hostname validation
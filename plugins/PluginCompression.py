@@ -25,8 +25,7 @@
 
 
 from plugins import PluginBase
-from utils.ctSSL import ctSSL_initialize, ctSSL_cleanup, constants, \
-    X509_V_CODES, SSL_CTX
+from utils.ctSSL import ctSSL_initialize, SSL_CTX
 from utils.SSLyzeSSLConnection import SSLyzeSSLConnection
 
 
@@ -42,38 +41,50 @@ class PluginCompression(PluginBase.PluginBase):
         dest=None)
 
     def process_task(self, target, command, args):
-        output_format = '        {0:<25} {1}'
 
-        ctSSL_initialize(zlib=True)
+        # Zlib is enabled for the whole process, but the other connections
+        # don't offer it
+        ctSSL_initialize(zlib=True) # Only enables Zlib the first time
 
         ssl_ctx = SSL_CTX.SSL_CTX('tlsv1') # sslv23 hello will fail for specific servers such as post.craigslist.org
         ssl_connect = SSLyzeSSLConnection(self._shared_settings, target,ssl_ctx,
-                                          hello_workaround=True)
-
+                                          hello_workaround=True,
+                                          compression=True)
         try: # Perform the SSL handshake
             ssl_connect.connect()
             compression_status = ssl_connect._ssl.get_current_compression()
         finally:
             ssl_connect.close()
-            
-        ctSSL_cleanup()
 
-        # Text output
+        return PluginBase.PluginResult(self.__class__, command, args,
+                                       {'compression' : compression_status})
+
+
+    def render_txt(self, plugin_result):
+        output_format = '        {0:<25} {1}'
+        compression_status = plugin_result.data['compression']
+
         if compression_status:
             comp_txt = 'Enabled ' +  compression_status
-            comp_xml = {'isSupported':'True','type':compression_status.strip('()')}
         else:
             comp_txt = 'Disabled'
-            comp_xml = {'isSupported':'False'}
             
         cmd_title = 'Compression'
         txt_result = [self.PLUGIN_TITLE_FORMAT.format(cmd_title)]
         txt_result.append(output_format.format("Compression Support:", comp_txt))
+        return txt_result
 
-        # XML output
-        xml_el = Element('compression', comp_xml)
-        xml_result = Element(command, title = cmd_title)
-        xml_result.append(xml_el)
 
-        return PluginBase.PluginResult(txt_result, xml_result)
+    def render_xml(self, plugin_result):
+        compression_status = plugin_result.data['compression']
 
+        if compression_status:
+            comp_xml = {'isSupported':'True','type':compression_status.strip('()')}
+        else:
+            comp_xml = {'isSupported':'False'}
+
+        cmd_title = 'Compression'
+        xml_el = Element('compression', comp_xml)
+        xml_result = Element(plugin_result.command, title = cmd_title)
+        xml_result.append(xml_el)
+        return xml_result
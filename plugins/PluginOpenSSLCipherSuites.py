@@ -26,13 +26,47 @@
 
 from plugins import PluginBase
 from utils.ThreadPool import ThreadPool
-from utils.ctSSL import SSL, SSL_CTX, constants, ctSSL_initialize, \
-    ctSSL_cleanup
+from utils.HandshakeEngine import HandshakeEngine
+from utils.ctSSL import SSL, SSL_CTX, constants
 from utils.SSLyzeSSLConnection import SSLyzeSSLConnection, SSLHandshakeRejected
+from utils.TargetContext import get_target_context
+
+
+class _PreferenceOrderDict(dict):
+    """
+    Dictionary of cipher suites that remembers the order they were added in,
+    which is the server's order of preference.
+    collections.OrderedDict requires Python 2.7.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self._key_list = []
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._key_list.append(key)
+        dict.__setitem__(self, key, value)
+
+    def items(self):
+        return [(key, self[key]) for key in self._key_list]
+
+    def iteritems(self):
+        return iter(self.items())
 
 
 class PluginOpenSSLCipherSuites(PluginBase.PluginBase):
 
+    # Runs last so the other plugins' handshakes tell us which protocols work
+    PLUGIN_PRIORITY = 10
+
+    # Rejections of the protocol probe meaning that the SSL version itself is
+    # not supported; any other failure could be specific to the cipher suites
+    # that were offered
+    PROTOCOL_REJECTED_ERRORS = ['Wrong version number', 'No ciphers available']
+
+    # Keeps the client hellos of --preference_order as small as the ones with
+    # SSLyzeSSLConnection.SSL_HELLO_WORKAROUND_CIPHERS
+    MAX_CIPHERS_PER_HELLO = 32
 
     available_commands = PluginBase.AvailableCommands(
         "PluginOpenSSLCipherSuites",
@@ -67,6 +101,13 @@ class PluginOpenSSLCipherSuites(PluginBase.PluginBase):
         help="Option - Hides the (usually long) list of cipher suites that were"
         " rejected by the server.",
         dest=None)   
+    available_commands.add_option(
+        option='preference_order',
+        help="Option - Lists the accepted cipher suites in the server's order "
+        "of preference. Only takes one handshake per accepted cipher suite, "
+        "by offering all the cipher suites and excluding the server's choice "
+        "until the handshake gets rejected.",
+        dest=None)
         
         
     def process_task(self, target, command, args):
@@ -79,12 +120,39 @@ def process_task(self, target, command, args):
             raise Exception("PluginOpenSSLCipherSuites: Unknown command.")
 
         # Get the list of available cipher suites for the given ssl version
-        ctSSL_initialize(multithreading=True)
         ctx = SSL_CTX.SSL_CTX(ssl_version)
         ctx.set_cipher_list('ALL:NULL:@STRENGTH')
         ssl = SSL.SSL(ctx)
         cipher_list = ssl.get_cipher_list()
 
+        if self._shared_settings['preference_order']:
+            result_dicts = self._scan_preference_order(target, ssl_version,
+                                                       cipher_list)
+            return self._create_result(command, args, result_dicts)
+
+        # Make sure the server supports this protocol at all before testing
+        # each cipher suite separately, unless another command already did
+        target_context = get_target_context(target)
+        if target_context and target_context.is_protocol_supported(ssl_version):
+            protocol_rejected = None
+        else:
+            protocol_rejected = self._test_protocol(target, ssl_version)
+        if protocol_rejected:
+            result_dicts = {'preferredCipherSuite':{}, 'acceptedCipherSuites':{},
+                            'rejectedCipherSuites':{}, 'errors':{}}
+            for cipher in cipher_list:
+                result_dicts['rejectedCipherSuites'][cipher] = \
+                    (str(protocol_rejected), None)
+            return self._create_result(command, args, result_dicts)
+
+        # Without HTTP GET, all the connections can be handled by a single
+        # thread; the handshake engine only supports direct connections
+        if not self._shared_settings['http_get'] \
+            and HandshakeEngine.is_supported(self._shared_settings):
+            result_dicts = self._scan_with_engine(target, ssl_version,
+                                                  cipher_list, MAX_THREADS)
+            return self._create_result(command, args, result_dicts)
+
         # Create a thread pool
         NB_THREADS = min(len(cipher_list), MAX_THREADS) # One thread per cipher
         thread_pool = ThreadPool()
@@ -120,17 +188,45 @@ def process_task(self, target, command, args):
             result_dicts['errors'][ssl_cipher] = (error_msg, None)        
             
         thread_pool.join()
-        ctSSL_cleanup()
         
         # Generate results
-        return PluginBase.PluginResult(self._generate_txt_result(result_dicts, command),
-                                       self._generate_xml_result(result_dicts, command))
+        return self._create_result(command, args, result_dicts)
+
+
+    def render_txt(self, plugin_result):
+        return self._generate_txt_result(plugin_result.data,
+                                         plugin_result.command)
+
+
+    def render_xml(self, plugin_result):
+        return self._generate_xml_result(plugin_result.data,
+                                         plugin_result.command)
         
          
 # == INTERNAL FUNCTIONS ==
 
+    def _create_result(self, command, args, result_dicts):
+        """
+        Turns each {cipher: (msg, keysize)} dictionary into a list of
+        (cipher, msg, keysize) tuples, which keeps the server's order of
+        preference.
+        """
+        result_lists = {}
+        for (result_type, result_dict) in result_dicts.iteritems():
+            result_lists[result_type] = \
+                [(cipher, msg, keysize) for (cipher, (msg, keysize))
+                 in result_dict.items()]
+        return PluginBase.PluginResult(self.__class__, command, args,
+                                       result_lists)
+
+
+    def _is_preference_ordered(self, result_type):
+        return result_type == 'acceptedCipherSuites' \
+            and self._shared_settings['preference_order']
+
+
 # FORMATTING FUNCTIONS
-    def _generate_txt_result(self, result_dicts, ssl_version):
+    def _generate_txt_result(self, result_lists, ssl_version):
         
         cipher_format = '        {0:<32}{1:<35}'
         title_format =  '      {0:<32} '        
@@ -150,9 +246,12 @@ def _generate_txt_result(self, result_dicts, ssl_version):
             
         for (result_type, result_title) in txt_titles:
             
-            # Sort the cipher suites by results
-            result_list = sorted(result_dicts[result_type].iteritems(), 
-                                 key=lambda (k,v): (v,k), reverse=True)
+            # Sort the cipher suites by results, unless they're already in
+            # the server's order of preference
+            result_list = list(result_lists[result_type])
+            if not self._is_preference_ordered(result_type):
+                result_list.sort(key=lambda (cipher, msg, keysize):
+                                 ((msg, keysize), cipher), reverse=True)
                                  
             # Add a new line and title
             txt_result.append('')
@@ -162,7 +261,7 @@ def _generate_txt_result(self, result_dicts, ssl_version):
                 txt_result.append(title_format.format(result_title))
 
                 # Add one line for each ciphers
-                for (cipher_txt, (msg, keysize)) in result_list:
+                for (cipher_txt, msg, keysize) in result_list:
                     if keysize:
                         cipher_txt = keysize_format.format(cipher_txt, keysize)
                                     
@@ -171,19 +270,23 @@ def _generate_txt_result(self, result_dicts, ssl_version):
         return txt_result
             
             
-    def _generate_xml_result(self, result_dicts, command):
+    def _generate_xml_result(self, result_lists, command):
                 
         xml_result = Element(command,  title = command.upper() + ' Cipher Suites')
         
-        for (result_type, result_dict) in result_dicts.items():
+        for result_type in ['preferredCipherSuite', 'acceptedCipherSuites',
+                            'rejectedCipherSuites', 'errors']:
             xml_dict = Element(result_type)
             
-            # Sort the cipher suites by name to make the XML diff-able
-            result_list = sorted(result_dict.items(), 
-                                 key=lambda (k,v): (k,v), reverse=False)
+            # Sort the cipher suites by name to make the XML diff-able, unless
+            # they're already in the server's order of preference
+            result_list = list(result_lists[result_type])
+            if not self._is_preference_ordered(result_type):
+                result_list.sort(key=lambda (cipher, msg, keysize):
+                                 (cipher, (msg, keysize)), reverse=False)
             
             # Add one element for each ciphers
-            for (ssl_cipher, (msg, keysize)) in result_list:
+            for (ssl_cipher, msg, keysize) in result_list:
                 cipher_xml_attr = {'name' : ssl_cipher, 'connectionStatus' : msg}
                 if keysize: 
                     cipher_xml_attr['keySize'] = keysize
@@ -196,7 +299,186 @@ def _generate_xml_result(self, result_dicts, command):
         return xml_result
             
             
-# SSL FUNCTIONS    
+# SSL FUNCTIONS
+    def _scan_preference_order(self, target, ssl_version, cipher_list):
+        """
+        Finds the cipher suite the server prefers among the remaining ones,
+        and removes it, until the server rejects them all. The accepted cipher
+        suites are returned in the server's order of preference.
+        Some servers don't reply to big client hellos, so the remaining cipher
+        suites are offered a few at a time: the server's choice within each
+        group is offered again with the next group, until it has been compared
+        with all of them.
+        """
+        result_dicts = {'preferredCipherSuite':{},
+                        'acceptedCipherSuites':_PreferenceOrderDict(),
+                        'rejectedCipherSuites':{}, 'errors':{}}
+        remaining_cipher_list = list(cipher_list)
+        group_size = self.MAX_CIPHERS_PER_HELLO - 1 # Room for the server's choice
+        error_msg = None
+        rejected_msg = None
+
+        while remaining_cipher_list and not error_msg:
+            preferred_cipher = None
+            for i in xrange(0, len(remaining_cipher_list), group_size):
+                cipher_group = remaining_cipher_list[i:i+group_size]
+                if preferred_cipher:
+                    cipher_group = [preferred_cipher[0]] + cipher_group
+
+                try:
+                    selected_cipher = self._get_selected_cipher(
+                        target, ssl_version, cipher_group)
+                except SSLHandshakeRejected as e:
+                    if preferred_cipher is None: # None of them are accepted
+                        for cipher in cipher_group:
+                            result_dicts['rejectedCipherSuites'][cipher] = \
+                                (str(e), None)
+                    rejected_msg = str(e)
+                    continue
+                except Exception as e:
+                    error_msg = str(e.__class__.__module__) + '.' \
+                        + str(e.__class__.__name__) + ' - ' + str(e)
+                    break
+
+                if selected_cipher[0] not in cipher_group: # Don't loop forever
+                    error_msg = 'Server selected a cipher suite that was not ' \
+                        'offered: ' + selected_cipher[0]
+                    break
+                preferred_cipher = selected_cipher
+
+            if error_msg:
+                break
+
+            if preferred_cipher:
+                (ssl_cipher, keysize, status_msg) = preferred_cipher
+                if not result_dicts['acceptedCipherSuites']:
+                    result_dicts['preferredCipherSuite'][ssl_cipher] = \
+                        (status_msg, keysize)
+                result_dicts['acceptedCipherSuites'][ssl_cipher] = \
+                    (status_msg, keysize)
+
+            nb_remaining = len(remaining_cipher_list)
+            remaining_cipher_list = [cipher for cipher in remaining_cipher_list
+                if cipher not in result_dicts['acceptedCipherSuites']
+                and cipher not in result_dicts['rejectedCipherSuites']]
+            if len(remaining_cipher_list) == nb_remaining:
+                break # Nothing new was learned; the server isn't consistent
+
+        # Whatever's left was not accepted
+        for cipher in remaining_cipher_list:
+            if error_msg:
+                result_dicts['errors'][cipher] = (error_msg, None)
+            else:
+                result_dicts['rejectedCipherSuites'][cipher] = \
+                    (rejected_msg, None)
+
+        return result_dicts
+
+
+    def _get_selected_cipher(self, target, ssl_version, cipher_group):
+        """
+        Offers the given cipher suites and returns the one the server selected,
+        its key size and the result of the post-handshake check.
+        """
+        ssl_ctx = SSL_CTX.SSL_CTX(ssl_version)
+        ssl_ctx.set_verify(constants.SSL_VERIFY_NONE)
+        ssl_ctx.set_cipher_list(':'.join(cipher_group))
+        ssl_connect = SSLyzeSSLConnection(self._shared_settings, target,
+                                          ssl_ctx)
+        try: # Perform the SSL handshake
+            ssl_connect.connect()
+            return (ssl_connect._ssl.get_current_cipher(),
+                    self._get_keysize(ssl_connect._ssl),
+                    ssl_connect.post_handshake_check())
+        finally:
+            ssl_connect.close()
+
+
+    def _test_protocol(self, target, ssl_version):
+        """
+        Initiates a SSL handshake with the server, to check that the SSL
+        version is supported. The client hello workaround is used as some
+        servers don't reply to big client hellos.
+        Returns the SSLHandshakeRejected exception if the server rejected the
+        SSL version itself, None otherwise.
+        """
+        ssl_ctx = SSL_CTX.SSL_CTX(ssl_version)
+        ssl_ctx.set_verify(constants.SSL_VERIFY_NONE)
+        ssl_connect = SSLyzeSSLConnection(self._shared_settings, target,
+                                          ssl_ctx, hello_workaround=True)
+
+        try: # Perform the SSL handshake
+            ssl_connect.connect()
+        except SSLHandshakeRejected as e:
+            for error_msg in self.PROTOCOL_REJECTED_ERRORS:
+                if error_msg in str(e):
+                    return e
+            return None # Maybe only these cipher suites were rejected
+        except: # Let the per-cipher tests figure out what's going on
+            return None
+        finally:
+            ssl_connect.close()
+
+        return None
+
+
+    def _scan_with_engine(self, target, ssl_version, cipher_list,
+                          max_in_flight):
+        """
+        Tests every cipher suite and looks for the preferred cipher suite,
+        performing all the handshakes concurrently within the current thread.
+        """
+        engine = HandshakeEngine(self._shared_settings, max_in_flight)
+
+        for cipher in cipher_list:
+            ssl_ctx = SSL_CTX.SSL_CTX(ssl_version)
+            ssl_ctx.set_verify(constants.SSL_VERIFY_NONE)
+            ssl_ctx.set_cipher_list(cipher)
+            engine.add_handshake(target, SSLyzeSSLConnection.create_ssl(
+                self._shared_settings, ssl_ctx), cipher)
+
+        ssl_ctx = SSL_CTX.SSL_CTX(ssl_version)
+        ssl_ctx.set_verify(constants.SSL_VERIFY_NONE)
+        engine.add_handshake(target, SSLyzeSSLConnection.create_ssl(
+            self._shared_settings, ssl_ctx, hello_workaround=True), None)
+
+        result_dicts = {'preferredCipherSuite':{}, 'acceptedCipherSuites':{},
+                        'rejectedCipherSuites':{}, 'errors':{}}
+
+        # Store the results as they come; the preferred cipher suite job is
+        # identified by a None cipher
+        for (cipher, ssl, exception) in engine.run():
+            if exception is None:
+                ssl_cipher = ssl.get_current_cipher()
+                result_type = 'acceptedCipherSuites' if cipher \
+                    else 'preferredCipherSuite'
+                result_dicts[result_type][ssl_cipher] = \
+                    ('', self._get_keysize(ssl))
+
+            elif cipher is None: # Preferred cipher suite errors are ignored
+                continue
+
+            elif isinstance(exception, SSLHandshakeRejected):
+                result_dicts['rejectedCipherSuites'][cipher] = \
+                    (str(exception), None)
+
+            else:
+                error_msg = str(exception.__class__.__module__) + '.' \
+                    + str(exception.__class__.__name__) + ' - ' + str(exception)
+                result_dicts['errors'][cipher] = (error_msg, None)
+
+        return result_dicts
+
+
+    @staticmethod
+    def _get_keysize(ssl):
+        ssl_cipher = ssl.get_current_cipher()
+        if 'ADH' in ssl_cipher or 'AECDH' in ssl_cipher:
+            return 'Anon' # Anonymous, let s not care about the key size
+        else:
+            return str(ssl.get_current_cipher_bits())+' bits'
+
+
     def _test_ciphersuite(self, target, ssl_version, ssl_cipher):
         """
         Initiates a SSL handshake with the server, using the SSL version and 
@@ -217,10 +499,7 @@ def _test_ciphersuite(self, target, ssl_version, ssl_cipher):
 
         else:
             ssl_cipher = ssl_connect._ssl.get_current_cipher()
-            if 'ADH' in ssl_cipher or 'AECDH' in ssl_cipher:
-                keysize = 'Anon' # Anonymous, let s not care about the key size
-            else:
-                keysize = str(ssl_connect._ssl.get_current_cipher_bits())+' bits'
+            keysize = self._get_keysize(ssl_connect._ssl)
                 
             status_msg = ssl_connect.post_handshake_check()
             return ('acceptedCipherSuites', ssl_cipher, keysize, status_msg)
@@ -249,10 +528,7 @@ def _pref_ciphersuite(self, target, ssl_version):
 
         else:
             ssl_cipher = ssl_connect._ssl.get_current_cipher()
-            if 'ADH' in ssl_cipher or 'AECDH' in ssl_cipher:
-                keysize = 'Anon' # Anonymous, let s not care about the key size
-            else:
-                keysize = str(ssl_connect._ssl.get_current_cipher_bits())+' bits'
+            keysize = self._get_keysize(ssl_connect._ssl)
                 
             status_msg = ssl_connect.post_handshake_check()
             return ('preferredCipherSuite', ssl_cipher, keysize, status_msg)
@@ -25,12 +25,15 @@
 from xml.etree.ElementTree import Element
 
 from plugins import PluginBase
-from utils.ctSSL import ctSSL_initialize, ctSSL_cleanup, SSL_CTX, \
-    constants, errors
-from utils.SSLyzeSSLConnection import SSLyzeSSLConnection
+from utils.ctSSL import errors
+from utils.HandshakeFacts import create_baseline_connection, \
+    record_handshake_facts
 
 class PluginSessionRenegotiation(PluginBase.PluginBase):
 
+    # Runs first so its handshake can be reused by the other plugins
+    PLUGIN_PRIORITY = -10
+
     available_commands = PluginBase.AvailableCommands(
         title="PluginSessionRenegotiation",
         description="")
@@ -44,13 +47,16 @@ class PluginSessionRenegotiation(PluginBase.PluginBase):
 
     def process_task(self, target, command, args):
 
-        ctSSL_initialize()
-        try:
-            (can_reneg, is_secure) = self._test_renegotiation(target)
-        finally:
-            ctSSL_cleanup()
-        
-        # Text output
+        (can_reneg, is_secure) = self._test_renegotiation(target)
+        return PluginBase.PluginResult(self.__class__, command, args,
+                                       {'canBeClientInitiated' : can_reneg,
+                                        'isSecure' : is_secure})
+
+
+    def render_txt(self, plugin_result):
+        can_reneg = plugin_result.data['canBeClientInitiated']
+        is_secure = plugin_result.data['isSecure']
+
         reneg_txt = 'Honored' if can_reneg else 'Rejected'
         secure_txt = 'Supported' if is_secure else 'Not supported'
         cmd_title = 'Session Renegotiation'
@@ -59,16 +65,22 @@ def process_task(self, target, command, args):
         RENEG_FORMAT = '      {0:<35} {1}'
         txt_result.append(RENEG_FORMAT.format('Client-initiated Renegotiations:', reneg_txt))
         txt_result.append(RENEG_FORMAT.format('Secure Renegotiation: ', secure_txt))
-        
-        # XML output
+        return txt_result
+
+
+    def render_xml(self, plugin_result):
+        can_reneg = plugin_result.data['canBeClientInitiated']
+        is_secure = plugin_result.data['isSecure']
+
+        cmd_title = 'Session Renegotiation'
         xml_reneg_attr = {'canBeClientInitiated' : str(can_reneg),
                           'isSecure' : str(is_secure)}
         xml_reneg = Element('sessionRenegotiation', attrib = xml_reneg_attr)
         
-        xml_result = Element(command, title = cmd_title)
+        xml_result = Element(plugin_result.command, title = cmd_title)
         xml_result.append(xml_reneg)
         
-        return PluginBase.PluginResult(txt_result, xml_result)
+        return xml_result
 
 
     def _test_renegotiation(self, target):
@@ -76,13 +88,13 @@ def _test_renegotiation(self, target):
         Checks whether the server honors session renegotiation requests and 
         whether it supports secure renegotiation.
         """
-        ssl_ctx = SSL_CTX.SSL_CTX('tlsv1') # sslv23 hello will fail for specific servers such as post.craigslist.org
-        ssl_ctx.set_verify(constants.SSL_VERIFY_NONE)
-        ssl_connect = SSLyzeSSLConnection(self._shared_settings, target,ssl_ctx,
-                                          hello_workaround=True)
+        # The renegotiation needs a live connection; use the baseline
+        # handshake for it so the other plugins don't have to do it again
+        ssl_connect = create_baseline_connection(self._shared_settings, target)
     
         try:
             ssl_connect.connect()
+            record_handshake_facts(target, ssl_connect)
             is_secure = ssl_connect._ssl.get_secure_renegotiation_support()
     
             try: # Let's try to renegotiate
@@ -24,7 +24,7 @@
 
 from plugins import PluginBase
 from utils.ThreadPool import ThreadPool
-from utils.ctSSL import SSL_CTX, constants, ctSSL_initialize, ctSSL_cleanup
+from utils.ctSSL import SSL_CTX, constants
 from utils.SSLyzeSSLConnection import SSLyzeSSLConnection
 
 
@@ -51,18 +51,68 @@ class PluginSessionResumption(PluginBase.PluginBase):
 
     def process_task(self, target, command, args):
 
-        ctSSL_initialize(multithreading=True)
-        try:
-            if command == 'resum':
-                result = self._command_resum(target)
-            elif command == 'resum_rate':
-                result = self._command_resum_rate(target)
-            else:
-                raise Exception("PluginSessionResumption: Unknown command.")
-        finally:
-            ctSSL_cleanup()
+        if command == 'resum':
+            data = self._command_resum(target)
+        elif command == 'resum_rate':
+            data = self._command_resum_rate(target)
+        else:
+            raise Exception("PluginSessionResumption: Unknown command.")
             
-        return result
+        return PluginBase.PluginResult(self.__class__, command, args, data)
+
+
+    def render_txt(self, plugin_result):
+        data = plugin_result.data
+        txt_resum = self._format_resum_id_txt(data['sessionIDs'])
+
+        if plugin_result.command == 'resum_rate':
+            cmd_title = 'Resumption Rate with Session IDs'
+            txt_result = [self.PLUGIN_TITLE_FORMAT.format(cmd_title)+' '+ txt_resum[0]]
+            txt_result.extend(txt_resum[1:])
+            return txt_result
+
+        ticket_dict = data['sessionTickets']
+        if ticket_dict['error']:
+            ticket_txt = 'Error: ' + ticket_dict['error']
+        else:
+            ticket_txt = 'Supported' if ticket_dict['isSupported'] \
+                                     else 'Not Supported - ' + ticket_dict['reason']+'.'
+        
+        cmd_title = 'Session Resumption'
+        txt_result = [self.PLUGIN_TITLE_FORMAT.format(cmd_title)]
+        RESUM_FORMAT = '      {0:<27} {1}'
+        
+        txt_result.append(RESUM_FORMAT.format('With Session IDs:', txt_resum[0]))
+        txt_result.extend(txt_resum[1:])
+        txt_result.append(RESUM_FORMAT.format('With TLS Session Tickets:', ticket_txt))
+        return txt_result
+
+
+    def render_xml(self, plugin_result):
+        data = plugin_result.data
+        xml_resum = self._format_resum_id_xml(data['sessionIDs'])
+
+        if plugin_result.command == 'resum_rate':
+            cmd_title = 'Resumption Rate with Session IDs'
+            xml_result = Element('resum_rate', title = cmd_title)
+            xml_result.append(xml_resum)
+            return xml_result
+
+        ticket_dict = data['sessionTickets']
+        xml_resum_ticket_attr = {}
+        if ticket_dict['error']:
+            xml_resum_ticket_attr['error'] = ticket_dict['error']
+        else:
+            xml_resum_ticket_attr['isSupported'] = str(ticket_dict['isSupported'])
+            if not ticket_dict['isSupported']:
+                xml_resum_ticket_attr['reason'] = ticket_dict['reason']
+        
+        cmd_title = 'Session Resumption'
+        xml_resum_ticket = Element('sessionResumptionWithTLSTickets', attrib = xml_resum_ticket_attr)   
+        xml_result = Element('resum', title=cmd_title)
+        xml_result.append(xml_resum)
+        xml_result.append(xml_resum_ticket)
+        return xml_result
 
 
     def _command_resum_rate(self, target):
@@ -79,20 +129,11 @@ def _command_resum_rate(self, target):
                                  (target, )))
         thread_pool.start(NB_THREADS)
         
-        # Format session ID results
-        (txt_resum, xml_resum) = self._format_resum_id_results(thread_pool, MAX_RESUM)
-
-        # Text output        
-        cmd_title = 'Resumption Rate with Session IDs'
-        txt_result = [self.PLUGIN_TITLE_FORMAT.format(cmd_title)+' '+ txt_resum[0]]
-        txt_result.extend(txt_resum[1:])
-        
-        # XML output
-        xml_result = Element('resum_rate', title = cmd_title)
-        xml_result.append(xml_resum)
+        # Count session ID results
+        resum_id_dict = self._get_resum_id_results(thread_pool, MAX_RESUM)
 
         thread_pool.join()
-        return PluginBase.PluginResult(txt_result, xml_result)
+        return {'sessionIDs' : resum_id_dict}
         
 
     def _command_resum(self, target):
@@ -110,50 +151,22 @@ def _command_resum(self, target):
         thread_pool.start(NB_THREADS)
         
         # Test TLS tickets support while threads are running
+        ticket_dict = {'isSupported' : None, 'reason' : None, 'error' : None}
         try:
-            (ticket_supported, ticket_reason) = self._resume_with_session_ticket(target)
-            ticket_error = None
+            (ticket_dict['isSupported'], ticket_dict['reason']) = \
+                self._resume_with_session_ticket(target)
         except Exception as e:
-            ticket_error = str(e.__class__.__module__) + '.' + \
-                            str(e.__class__.__name__) + ' - ' + str(e)
+            ticket_dict['error'] = str(e.__class__.__module__) + '.' + \
+                                   str(e.__class__.__name__) + ' - ' + str(e)
 
-        # Format session ID results
-        (txt_resum, xml_resum) = self._format_resum_id_results(thread_pool, MAX_RESUM)
-
-        if ticket_error:
-            ticket_txt = 'Error: ' + ticket_error
-        else:
-            ticket_txt = 'Supported' if ticket_supported \
-                                     else 'Not Supported - ' + ticket_reason+'.'
-        
-        cmd_title = 'Session Resumption'
-        txt_result = [self.PLUGIN_TITLE_FORMAT.format(cmd_title)]
-        RESUM_FORMAT = '      {0:<27} {1}'
-        ERRORS_FORMAT ='        Error #{0}: {1}'
-        
-        txt_result.append(RESUM_FORMAT.format('With Session IDs:', txt_resum[0]))
-        txt_result.extend(txt_resum[1:])
-        txt_result.append(RESUM_FORMAT.format('With TLS Session Tickets:', ticket_txt))
-        
-        # XML output
-        xml_resum_ticket_attr = {}
-        if ticket_error:
-            xml_resum_ticket_attr['error'] = ticket_error
-        else:
-            xml_resum_ticket_attr['isSupported'] = str(ticket_supported)
-            if not ticket_supported:
-                xml_resum_ticket_attr['reason'] = ticket_reason
-        
-        xml_resum_ticket = Element('sessionResumptionWithTLSTickets', attrib = xml_resum_ticket_attr)   
-        xml_result = Element('resum', title=cmd_title)
-        xml_result.append(xml_resum)
-        xml_result.append(xml_resum_ticket)
+        # Count session ID results
+        resum_id_dict = self._get_resum_id_results(thread_pool, MAX_RESUM)
 
         thread_pool.join()
-        return PluginBase.PluginResult(txt_result, xml_result)
+        return {'sessionIDs' : resum_id_dict, 'sessionTickets' : ticket_dict}
 
 
-    def _format_resum_id_results(self, thread_pool, MAX_RESUM):
+    def _get_resum_id_results(self, thread_pool, MAX_RESUM):
         # Count successful/failed resumptions
         nb_resum = 0
         for completed_job in thread_pool.get_result():
@@ -168,11 +181,19 @@ def _format_resum_id_results(self, thread_pool, MAX_RESUM):
             error_msg = str(exception.__class__.__module__) + '.' \
             + str(exception.__class__.__name__) + ' - ' + str(exception)
             error_list.append(error_msg)
+
+        return {'totalAttempts' : MAX_RESUM,
+                'successfulAttempts' : nb_resum,
+                'errorList' : error_list}
+
+
+    def _format_resum_id_txt(self, resum_id_dict):
+        MAX_RESUM = resum_id_dict['totalAttempts']
+        nb_resum = resum_id_dict['successfulAttempts']
+        error_list = resum_id_dict['errorList']
         nb_error = len(error_list)
-        
         nb_failed = MAX_RESUM - nb_error - nb_resum
             
-        # Text output
         sessid_format = '{4} ({0} successful, {1} failed, {2} errors, {3} total attempts).{5}'
         sessid_try = '' 
         if nb_resum == MAX_RESUM:
@@ -197,8 +218,17 @@ def _format_resum_id_results(self, thread_pool, MAX_RESUM):
             for error_msg in error_list:
                 i+=1
                 txt_result.append(ERRORS_FORMAT.format(str(i), error_msg))
-        
-        # XML output
+
+        return txt_result
+
+
+    def _format_resum_id_xml(self, resum_id_dict):
+        MAX_RESUM = resum_id_dict['totalAttempts']
+        nb_resum = resum_id_dict['successfulAttempts']
+        error_list = resum_id_dict['errorList']
+        nb_error = len(error_list)
+        nb_failed = MAX_RESUM - nb_error - nb_resum
+
         sessid_xml = str(nb_resum == MAX_RESUM)
         xml_resum_id_attr = {'totalAttempts':str(MAX_RESUM), 
                              'errors' : str(nb_error), 'isSupported' : sessid_xml,
@@ -211,7 +241,7 @@ def _format_resum_id_results(self, thread_pool, MAX_RESUM):
                 xml_resum_error.text = error_msg
                 xml_resum_id.append(xml_resum_error)
         
-        return (txt_result, xml_resum_id)
+        return xml_resum_id
     
 
     def _resume_with_session_id(self, target):
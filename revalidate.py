@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         revalidate.py
+# Purpose:      Validates the certificate chains found in SSLyze's JSON output
+#               against other CA stores, without scanning the servers again.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+import optparse
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+from utils.ProcessPool import get_max_processes
+from utils.CertChainValidator import init_validation_process, validate_chain
+
+REVALIDATE_VERSION = 'SSLyzeRevalidate v0.1 beta'
+DEFAULT_CA_STORE = 'mozilla:' + os.path.join(sys.path[0], 'mozilla_cacert.pem')
+CHUNK_SIZE = 64 # Records sent to a validation process at a time
+
+# Command line parser
+parser = optparse.OptionParser(version=REVALIDATE_VERSION)
+# JSON input
+parser.add_option(
+    '--json_in',
+    help= (
+        'Input file containing SSLyze results from --json_out, with --certinfo '
+        'and --keep_certificate_chain enabled. JSON_IN should be the name of '
+        'the file to read from.'),
+    dest='json_in',
+    default=None)
+
+# CA stores
+parser.add_option(
+    '--ca_store',
+    help= (
+        'CA store to validate the certificate chains against. CA_STORE should '
+        'be \'name:file\', where file is a PEM file of trusted certificates. '
+        'Can be used several times. Default is Mozilla\'s CA store.'),
+    action='append',
+    dest='ca_store',
+    default=None)
+
+# JSON output
+parser.add_option(
+    '--json_out',
+    help= (
+        'Writes the results to a file, one JSON object per line. '
+        'JSON_OUT should be the name of the file to write to.'),
+    dest='json_out',
+    default=None)
+
+# Performance
+parser.add_option(
+    '--nb_processes',
+    help= (
+        'Number of processes validating the chains. Default is one per CPU.'),
+    type='int',
+    dest='nb_processes',
+    default=None)
+
+
+def _read_chain_records(json_in):
+    """
+    Yields (host, ip, port, sha1Fingerprint, certificateChain) for each
+    certinfo result in the file.
+    Results that don't have the chain (no --keep_certificate_chain) are
+    skipped.
+    """
+    with open(json_in) as json_file:
+        for line in json_file:
+            record = json.loads(line)
+            if record['command'] != 'certinfo' or record['error'] \
+            or 'certificateChain' not in record['data']:
+                continue
+            yield (record['host'], record['ip'], record['port'],
+                   record['data']['sha1Fingerprint'],
+                   record['data']['certificateChain'])
+
+
+def _revalidate_record(chain_record):
+    # Runs within the validation processes
+    (host, ip, port, fingerprint, certificate_chain) = chain_record
+    try:
+        validation_dict = validate_chain(certificate_chain)
+    except Exception as e: # Keep going with the other chains
+        validation_dict = str(e.__class__.__name__) + ' - ' + str(e)
+    return (host, ip, port, fingerprint, validation_dict)
+
+
+def main():
+
+    # Parse the command line
+    (args, foo) = parser.parse_args()
+    if args.json_in == None:
+        print 'Command line error: you need to specify the name of the json input file'
+        return
+
+    ca_store_files = []
+    for ca_store in (args.ca_store or [DEFAULT_CA_STORE]):
+        try:
+            (name, pem_file) = ca_store.split(':', 1)
+        except ValueError:
+            print 'Command line error: --ca_store should be \'name:file\''
+            return
+        if not os.path.isfile(pem_file):
+            print 'Command line error: could not find ' + pem_file
+            return
+        ca_store_files.append((name, pem_file))
+
+    json_file = None
+    if args.json_out:
+        json_file = open(args.json_out, 'w')
+
+    # Each process loads the CA stores once and keeps its own cache of the
+    # chains it already validated
+    pool = Pool(get_max_processes(args.nb_processes), init_validation_process,
+                (ca_store_files,))
+    nb_chains = 0
+    for (host, ip, port, fingerprint, validation_dict) in pool.imap(
+            _revalidate_record, _read_chain_records(args.json_in), CHUNK_SIZE):
+        nb_chains += 1
+
+        if json_file:
+            record = {'host' : host, 'ip' : ip, 'port' : port,
+                      'sha1Fingerprint' : fingerprint}
+            if isinstance(validation_dict, dict):
+                record['caStores'] = validation_dict
+            else:
+                record['error'] = validation_dict
+            json_file.write(json.dumps(record, sort_keys=True) + '\n')
+            continue
+
+        print host + ':' + str(port) + ' - ' + fingerprint
+        if not isinstance(validation_dict, dict):
+            print '      ERROR: ' + validation_dict
+            continue
+        for (name, validation) in sorted(validation_dict.iteritems()):
+            if validation['isTrusted']:
+                trust_txt = 'Certificate is Trusted'
+            else:
+                trust_txt = 'Certificate is NOT Trusted: ' + \
+                            validation['reasonWhyNotTrusted']
+            print '      {0:<35}{1:<35}'.format(name + ':', trust_txt)
+
+    pool.close()
+    pool.join()
+    if json_file:
+        json_file.close()
+    print '\n Revalidated ' + str(nb_chains) + ' certificate chains.'
+
+
+if __name__ == "__main__":
+    main()
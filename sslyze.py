@@ -21,20 +21,32 @@
 #   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
 #-------------------------------------------------------------------------------
 
-from time import time
+from time import time, sleep
 from multiprocessing import Process, JoinableQueue
-from xml.etree.ElementTree import ElementTree, Element, tostring
-from xml.dom import minidom
+from Queue import Queue, Empty
+from socket import gethostname
+from threading import Thread
+from xml.etree.ElementTree import Element
 
+from utils.ctSSL import ctSSL_initialize, ctSSL_cleanup
 from utils.discover_targets import discover_targets
 from utils.discover_plugins import discover_plugins
+from utils.ProcessPool import ProcessPool, get_max_processes
+from utils.ResultCache import ResultCache
+from utils.ScanCheckpoint import ScanCheckpoint
+from utils.ScanCoordinator import start_coordinator, connect_to_coordinator, \
+    HEARTBEAT_INTERVAL, COORDINATOR_ONLY_SETTINGS
+from utils.ConnectionRateLimiter import ConnectionRateLimiter
+from utils.TargetContext import open_target_context, close_target_context
+from utils.XMLStreamWriter import XMLStreamWriter
+from utils.JSONLinesWriter import JSONLinesWriter
 from utils.parse_command_line import create_command_line_parser, \
     parse_command_line, process_parsing_results, PARSING_ERROR_FORMAT
 
 
 
 SSLYZE_VERSION =      'SSLyze v0.5'
-DEFAULT_NB_PROCESSES =      5 # 10 was too aggressive, lowering it to 5
+DEFAULT_NB_PROCESSES =      5 # Minimum size of the process pool
 PLUGIN_PATH =       "plugins"
 DEFAULT_TIMEOUT =   5
 PROJECT_URL = "https://github.com/isecPartners/sslyze"
@@ -57,41 +69,213 @@ def run(self):
         Once it gets notified that all the tasks have been completed,
         it terminates.
         """
-        from plugins.PluginBase import PluginResult    
-        # Plugin classes are unpickled by the multiprocessing module
-        # without state info. Need to assign shared_settings here
-        for plugin_class in self.available_commands.itervalues():
-            plugin_class._shared_settings = self.shared_settings
+        plugin_instance_dict = self._setup()
         
         while True:
 
             task = self.queue_in.get() # Grab a task from queue_in
 
             if task == None: # All the tasks have been completed
+                self._teardown(plugin_instance_dict)
                 self.queue_out.put(None) # Pass on the sentinel to result_queue
                 self.queue_in.task_done()
                 break
 
-            (target, command, args) = task
-            # Instatiate the proper plugin
-            plugin_instance = self.available_commands[command]()
-                
+            self._process_work_unit(task, plugin_instance_dict)
+            self.queue_in.task_done()
+
+        return
+
+
+    def _setup(self):
+        """
+        Prepares the process for running plugins and returns the dictionnary
+        the plugin instances will be kept in.
+        """
+        # Plugin classes are unpickled by the multiprocessing module
+        # without state info. Need to assign shared_settings here
+        for plugin_class in self.available_commands.itervalues():
+            plugin_class._shared_settings = self.shared_settings
+
+        # OpenSSL only needs to be initialized once per process, and plugin
+        # instances get reused for all the tasks
+        ctSSL_initialize(multithreading=True)
+        return {}
+
+
+    def _process_work_unit(self, task, plugin_instance_dict):
+        """
+        Runs each command of a work unit and puts each result in
+        self.queue_out.
+        """
+        from plugins.PluginBase import PluginResult    
+
+        # A work unit contains one or more commands for the same target;
+        # they share what gets learned about the target along the way
+        (target, command_list) = task
+        target_context = open_target_context(target)
+
+        for (command, args) in command_list:
+            if self.shared_settings['skip_discovery'] \
+            and target_context.is_reachable() is False:
+                # The first connection was the liveness probe and it failed;
+                # don't bother with the remaining commands
+                result = PluginResult(
+                    self.available_commands[command], command, args,
+                    error='Cancelled, target unreachable: ' + \
+                          target_context.get_unreachable_reason())
+                self.queue_out.put((target, command, result))
+                continue
+
+            # Instatiate the proper plugin if we don't have one already
+            plugin_class = self.available_commands[command]
+            if plugin_class not in plugin_instance_dict:
+                plugin_instance_dict[plugin_class] = plugin_class()
+            plugin_instance = plugin_instance_dict[plugin_class]
+            
             try: # Process the task
                 result = plugin_instance.process_task(target, command, args)
-            except Exception as e: # Generate txt and xml results
-                txt_result = ['Unhandled exception when processing --' + 
-                              command + ': ', str(e.__class__.__module__) + 
-                              '.' + str(e.__class__.__name__) + ' - ' + str(e)]
-                xml_result = Element(command, exception=txt_result[1])
-                result = PluginResult(txt_result, xml_result)
+            except Exception as e: # Keep the error message
+                error_msg = str(e.__class__.__module__) + '.' + \
+                            str(e.__class__.__name__) + ' - ' + str(e)
+                result = PluginResult(plugin_class, command, args,
+                                      error=error_msg)
 
             # Send the result to queue_out
             self.queue_out.put((target, command, result))
-            self.queue_in.task_done()
 
+        close_target_context(target)
+
+
+    def _teardown(self, plugin_instance_dict):
+        """
+        Lets each plugin instance release its resources, then cleans up
+        OpenSSL.
+        """
+        for plugin_instance in plugin_instance_dict.itervalues():
+            try:
+                plugin_instance.teardown()
+            except Exception:
+                pass # We're exiting anyway
+        ctSSL_cleanup()
+
+
+class AgentWorkerProcess(WorkerProcess):
+    """
+    Worker process of an agent: gets its tasks from a coordinator running on
+    another host, and sends the results back to it.
+    """
+
+    def __init__(self, coordinator_address, authkey, available_commands,
+                 shared_settings):
+        WorkerProcess.__init__(self, None, None, available_commands,
+                               shared_settings)
+        self.coordinator_address = coordinator_address
+        self.authkey = authkey
+
+    def run(self):
+        """
+        The process completes work units until the coordinator tells it the
+        scan is over, or goes away.
+        """
+        # Each process needs its own connection to the coordinator
+        manager = connect_to_coordinator(self.coordinator_address,
+                                         self.authkey)
+        dispatcher = manager.get_dispatcher()
+        agent_id = gethostname() + ':' + str(self.pid)
+
+        heartbeat_thread = Thread(target=self._send_heartbeats,
+                                  args=(dispatcher, agent_id))
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        # The results of a work unit are sent back all at once
+        self.queue_out = Queue()
+        plugin_instance_dict = self._setup()
+
+        while True:
+            try:
+                work_unit = dispatcher.take_task(agent_id)
+                if work_unit == None: # The scan is over
+                    break
+
+                (unit_id, task) = work_unit
+                self._process_work_unit(task, plugin_instance_dict)
+                result_list = []
+                while not self.queue_out.empty():
+                    result_list.append(self.queue_out.get())
+                dispatcher.task_done(agent_id, unit_id, result_list)
+
+            except (EOFError, IOError): # The coordinator is done
+                break
+
+        self._teardown(plugin_instance_dict)
         return
 
 
+    @staticmethod
+    def _send_heartbeats(dispatcher, agent_id):
+        # Lets the coordinator know this process is still working on its
+        # work unit
+        while True:
+            sleep(HEARTBEAT_INTERVAL)
+            try:
+                dispatcher.heartbeat(agent_id)
+            except (EOFError, IOError):
+                return
+
+
+def _run_agent(shared_settings, available_commands):
+    """
+    Connects to the coordinator given with --agent and processes its tasks
+    with a pool of AgentWorkerProcess until the coordinator goes away.
+    """
+    coordinator_address = shared_settings['agent']
+    authkey = shared_settings['authkey']
+    print _format_title('Connecting to coordinator ' + coordinator_address)
+    try:
+        manager = connect_to_coordinator(coordinator_address, authkey)
+        agent_settings = manager.get_shared_settings()._getvalue()
+    except Exception as e:
+        print '   ERROR: Could not connect to the coordinator: ' + str(e)
+        return
+
+    # The scan settings come from the coordinator, except for the ones that
+    # only make sense on its host; the rate limits apply to this agent only
+    for key in COORDINATOR_ONLY_SETTINGS:
+        agent_settings[key] = shared_settings[key]
+    if agent_settings['max_rate'] or agent_settings['max_rate_per_target']:
+        agent_settings['rate_limiter'] = ConnectionRateLimiter(
+            agent_settings['max_rate'], agent_settings['max_rate_per_target'])
+    else:
+        agent_settings['rate_limiter'] = None
+
+    nb_processes = get_max_processes(shared_settings['nb_processes'],
+                                     DEFAULT_NB_PROCESSES)
+    process_list = []
+    for i in xrange(nb_processes):
+        process = AgentWorkerProcess(coordinator_address, authkey,
+                                     available_commands, agent_settings)
+        process.start()
+        process_list.append(process)
+
+    print '   Connected, running ' + str(nb_processes) + ' processes.\n'
+    [process.join() for process in process_list]
+    print _format_title('Coordinator done')
+
+
+def _get_available_results(result_queue):
+    """
+    Returns the results that are already in result_queue, without waiting.
+    """
+    result_list = []
+    while True:
+        try:
+            result_list.append(result_queue.get_nowait())
+        except Empty:
+            return result_list
+
+
 def _format_title(title):
     return ' ' + title.upper()+ '\n' + ' ' + ('-' * len(title))
 
@@ -123,8 +307,6 @@ def _format_txt_target_result(target, result_list):
 
 def main():
 
-    nb_processes = DEFAULT_NB_PROCESSES
-
     #--PLUGINS INITIALIZATION--
     start_time = time()
     print '\n\n\n' + _format_title('Registering available plugins')
@@ -150,30 +332,15 @@ def main():
     if not shared_settings:
         return
 
+    # Agents only process the tasks of a coordinator on another host
+    if shared_settings['agent']:
+        _run_agent(shared_settings, available_commands)
+        return
 
-    #--PROCESSES INITIALIZATION--
-    task_queue = JoinableQueue() # Processes get tasks from task_queue and
-    result_queue = JoinableQueue() # put the result of each task in result_queue
-
-    # Spawn a pool of processes, and pass them the queues
-    process_list = []
-    for i in xrange(nb_processes):
-        p = WorkerProcess(task_queue, result_queue, available_commands, \
-                            shared_settings)
-        p.start()
-        process_list.append(p) # Keep track of the processes that were started
-
-
-    #--TESTING SECTION--
-    # Figure out which hosts are up and fill the task queue with work to do
-    print _format_title('Checking host(s) availability')
-    alive_target_list = discover_targets(args_target_list, args_command_list,\
-                                         available_commands, task_queue)
-    print '\n\n'
+    # Plugin results get rendered within this process
+    for plugin_class in available_commands.itervalues():
+        plugin_class._shared_settings = shared_settings
 
-    # Put a 'None' sentinel in the queue to let the each process know when every
-    # task has been completed
-    [task_queue.put(None) for process in process_list]
 
     # Keep track of how many tasks have to be performed for each target
     task_num=0
@@ -182,69 +349,176 @@ def main():
             task_num+=1
 
 
+    # Results of previous scans can be reused: the journal of an interrupted
+    # scan comes first, then the result cache
+    result_sources = []
+    if shared_settings['checkpoint_file']:
+        try:
+            result_sources.append(ScanCheckpoint(
+                shared_settings['checkpoint_file'], shared_settings,
+                available_commands, shared_settings['resume']))
+        except (IOError, ValueError) as e:
+            print PARSING_ERROR_FORMAT.format(
+                'Could not use the --checkpoint file: ' + str(e))
+            return
+
+    if shared_settings['cache_file']:
+        result_sources.append(ResultCache(shared_settings['cache_file'],
+                                          shared_settings['cache_ttl'],
+                                          shared_settings, available_commands))
+
+
+    #--PROCESSES INITIALIZATION--
+    task_queue = JoinableQueue() # Processes get tasks from task_queue and
+    result_queue = JoinableQueue() # put the result of each task in result_queue
+
+    # Let agents on other hosts take some of the tasks; their results come
+    # back through result_queue like the local ones
+    if shared_settings['coordinator']:
+        try:
+            dispatcher = start_coordinator(shared_settings['coordinator'],
+                                           shared_settings['authkey'],
+                                           task_queue, result_queue,
+                                           shared_settings)
+        except Exception as e:
+            print PARSING_ERROR_FORMAT.format(
+                'Could not listen on ' + shared_settings['coordinator'] + ': '
+                + str(e))
+            return
+        print _format_title('Waiting for agents on ' +
+                            shared_settings['coordinator'])
+        print ''
+
+    # The pool's size depends on the number of CPUs, the --nb_processes budget
+    # and the number of tasks left to process
+    max_processes = get_max_processes(shared_settings['nb_processes'],
+                                      DEFAULT_NB_PROCESSES)
+    process_pool = ProcessPool(
+        lambda: WorkerProcess(task_queue, result_queue, available_commands,
+                              shared_settings),
+        task_queue, max_processes)
+
     # --REPORTING SECTION--
-    processes_running = nb_processes
-    
-    # XML output
+    # XML output: each target gets written out as soon as it's done, and the
+    # targets get sorted by host when the document is closed
     if shared_settings['xml_file']:
-        xml_output_list = []
-
-    # Each host has a list of results
-    result_dict = {}
-    for target in alive_target_list:
-        result_dict[target] = []
+        xml_writer = XMLStreamWriter(
+            shared_settings['xml_file'],
+            {'title' : "SSLyze Scan Results",
+             'SSLyzeVersion' : SSLYZE_VERSION,
+             'SSLyzeWeb' : PROJECT_URL},
+            {'httpsTunnel':str(shared_settings['https_tunnel_host']),
+             'defaultTimeout' : str(shared_settings['timeout']),
+             'startTLS' : str(shared_settings['starttls'])},
+            ['totalScanTime'])
 
-    # If all processes have stopped, all the work is done
-    while processes_running:
-        result = result_queue.get()
+    # JSON Lines output: each result gets written as soon as it comes in
+    if shared_settings['json_file']:
+        json_writer = JSONLinesWriter(shared_settings['json_file'])
 
-        if result == None: # Getting None means that one process was done
-            processes_running -= 1
+    # With --group_by_target, a work unit is only done when all the results
+    # for its target came in
+    scanned_target_set = set()
 
-        else: # Getting an actual result
-            (target, command, plugin_result) = result
-            result_dict[target].append((command, plugin_result))
 
-            if len(result_dict[target]) == task_num: # Done with this target
-                # Print the results and update the xml doc
-                print _format_txt_target_result(target, result_dict[target])
-                if shared_settings['xml_file']:
-                    xml_output_list.append(_format_xml_target_result(target, result_dict[target]))
-                           
-        result_queue.task_done()
+    #--TESTING SECTION--
+    # Figure out which hosts are up and fill the task queue with work to do
+    # The pool grows as targets are found, so that the processes can start
+    # working while we look for the other targets. Their results get reported
+    # right away, so that they're not lost if the scan gets interrupted.
+    print _format_title('Checking host(s) availability')
+    nb_pending_tasks = 0
+    nb_cached_results = 0 # Cached results not received yet
+    result_dict = {} # Each host has a list of results
+    target_discovery = discover_targets(args_target_list, args_command_list,
+                                        available_commands, task_queue,
+                                        result_queue, result_sources,
+                                        shared_settings['rate_limiter'])
+    is_discovery_done = False
+
+    # Once all the targets were found, if all processes have stopped and all
+    # cached results were received, all the work is done
+    while not is_discovery_done or process_pool.get_nb_processes() \
+    or nb_cached_results:
+
+        if is_discovery_done:
+            result_list = [result_queue.get()]
+        else:
+            try:
+                (target, nb_work_units) = target_discovery.next()
+            except StopIteration:
+                is_discovery_done = True
+                print '\n\n'
+                # Results found in the journal or the cache were directly put
+                # in result_queue
+                nb_cached_results += sum([result_source.get_nb_served()
+                                          for result_source in result_sources])
+                continue
+
+            if target: # Nothing new if discovery was just idle
+                result_dict.setdefault(target, [])
+                nb_pending_tasks += nb_work_units
+                process_pool.adjust(nb_pending_tasks)
+            result_list = _get_available_results(result_queue)
+
+        for result in result_list:
+            if result == None: # Getting None means that one process was done
+                process_pool.process_exited()
+
+            else: # Getting an actual result
+                (target, command, plugin_result) = result
+                result_dict[target].append((command, plugin_result))
+
+                args = shared_settings[command]
+                if shared_settings['json_file']:
+                    json_writer.write_result(target, plugin_result)
+
+                if any(result_source.was_served(target, command, args)
+                       for result_source in result_sources):
+                    nb_cached_results -= 1
+                else:
+                    for result_source in result_sources:
+                        result_source.put(target, command, args, plugin_result)
+
+                    if shared_settings['group_by_target']:
+                        scanned_target_set.add(target)
+                    else: # Release processes we don't need anymore
+                        nb_pending_tasks -= 1
+                        process_pool.adjust(nb_pending_tasks)
+
+                if len(result_dict[target]) == task_num: # Done with this target
+                    if target in scanned_target_set:
+                        scanned_target_set.remove(target)
+                        nb_pending_tasks -= 1
+                        process_pool.adjust(nb_pending_tasks)
+
+                    # Print the results and update the xml doc
+                    print _format_txt_target_result(target, result_dict[target])
+                    if shared_settings['xml_file']:
+                        xml_writer.write_target(_format_xml_target_result(target, result_dict[target]))
+
+            result_queue.task_done()
 
 
     # --TERMINATE--
-    
+    if shared_settings['coordinator']: # Let the agents go
+        dispatcher.stop()
+
     # Make sure all the processes had time to terminate
     task_queue.join()
     result_queue.join()
-    #[process.join() for process in process_list] # Causes interpreter shutdown errors
+    process_pool.join()
     exec_time = time()-start_time
+
+    for result_source in result_sources:
+        result_source.close()
     
-    # Output XML doc to a file if needed
+    if shared_settings['json_file']:
+        json_writer.close()
+
+    # Finish the XML doc if needed
     if shared_settings['xml_file']:
-        result_xml_attr = {'httpsTunnel':str(shared_settings['https_tunnel_host']),
-                           'totalScanTime' : str(exec_time), 
-                           'defaultTimeout' : str(shared_settings['timeout']), 
-                           'startTLS' : str(shared_settings['starttls'])}
-        
-        result_xml = Element('results', attrib = result_xml_attr)
-        
-        # Sort results in alphabetical order to make the XML files (somewhat) diff-able
-        xml_output_list.sort(key=lambda xml_elem: xml_elem.attrib['host'])
-        for xml_element in xml_output_list:
-            result_xml.append(xml_element)
-            
-        xml_final_doc = Element('document', title = "SSLyze Scan Results",
-                                SSLyzeVersion = SSLYZE_VERSION, 
-                                SSLyzeWeb = PROJECT_URL)
-        xml_final_doc.append(result_xml)
-
-        # Hack: Prettify the XML file so it's (somewhat) diff-able
-        xml_final_pretty = minidom.parseString(tostring(xml_final_doc, encoding='UTF-8'))
-        with open(shared_settings['xml_file'],'w') as xml_file:
-            xml_file.write(xml_final_pretty.toprettyxml(indent="  ", encoding="utf-8" ))
+        xml_writer.close({'totalScanTime' : str(exec_time)})
             
 
     print _format_title('Scan Completed in {0:.2f} s'.format(exec_time))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         BoundedCache.py
+# Purpose:      Dictionary that only keeps a given number of entries, to cache
+#               values that are expensive to compute within long-running
+#               processes.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+from collections import deque
+
+
+class BoundedCache:
+    """
+    Maps keys to values, up to max_entries of them. When full, the oldest
+    entry is dropped to make room for the new one.
+    """
+
+    def __init__(self, max_entries):
+        """
+        @type max_entries: int
+        @param max_entries: Number of entries to keep.
+        """
+        self._max_entries = max_entries
+        self._entry_dict = {}
+        self._key_queue = deque() # Oldest key first
+
+
+    def get(self, key, default=None):
+        return self._entry_dict.get(key, default)
+
+
+    def put(self, key, value):
+        if key not in self._entry_dict:
+            if len(self._key_queue) >= self._max_entries:
+                del self._entry_dict[self._key_queue.popleft()]
+            self._key_queue.append(key)
+        self._entry_dict[key] = value
+
+
+    def __len__(self):
+        return len(self._entry_dict)
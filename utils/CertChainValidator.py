@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         CertChainValidator.py
+# Purpose:      Validates certificate chains captured by PluginCertInfo
+#               against one or more CA stores, without connecting to the
+#               servers again.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+from base64 import b64decode
+
+from utils.ctSSL import ctSSL_initialize, X509, X509_STORE, X509_V_CODES
+from utils.BoundedCache import BoundedCache
+
+
+# Same chains tend to show up many times (load balancers, shared hosting...)
+# and a handful of intermediate certificates are in most of them
+MAX_CACHED_CHAINS = 1024
+MAX_CACHED_CERTIFICATES = 1024
+
+# The CA stores and the caches only live within each validation process:
+# ctSSL objects can't be sent to other processes
+_ca_store_list = [] # (name, ctSSL.X509_STORE.X509_STORE)
+_verify_result_cache = BoundedCache(MAX_CACHED_CHAINS)
+_x509_cache = BoundedCache(MAX_CACHED_CERTIFICATES) # Base64 DER -> X509
+
+
+def init_validation_process(ca_store_files):
+    """
+    Loads the CA stores within the current process. To be called once in each
+    validation process, before validate_chain(); for example as the
+    initializer of a multiprocessing.Pool.
+
+    @type ca_store_files: [(str, str)]
+    @param ca_store_files: Name and path to the PEM file of each CA store.
+    """
+    ctSSL_initialize()
+    for (name, pem_file) in ca_store_files:
+        x509_store = X509_STORE.X509_STORE()
+        for x509 in X509.load_pem_file(pem_file):
+            x509_store.add_cert(x509)
+        _ca_store_list.append((name, x509_store))
+
+
+def validate_chain(certificate_chain):
+    """
+    Validates a certificate chain against each of the CA stores loaded by
+    init_validation_process().
+
+    @type certificate_chain: [str]
+    @param certificate_chain: Base64-encoded DER certificates, starting with
+    the server's certificate; as found in the results of PluginCertInfo.
+
+    @rtype: dict
+    @return: For each CA store name, a dict with 'isTrusted' and
+    'reasonWhyNotTrusted'.
+    """
+    chain_key = tuple(certificate_chain)
+    validation_dict = _verify_result_cache.get(chain_key)
+    if validation_dict:
+        return validation_dict
+
+    x509_chain = [_load_certificate(der) for der in certificate_chain]
+    validation_dict = {}
+    for (name, x509_store) in _ca_store_list:
+        # The rest of the chain is untrusted, like during the handshake
+        verify_result = x509_store.verify_cert(x509_chain[0], x509_chain[1:])
+        if verify_result == 0:
+            validation_dict[name] = {'isTrusted' : True,
+                                     'reasonWhyNotTrusted' : None}
+        else:
+            validation_dict[name] = \
+                {'isTrusted' : False,
+                 'reasonWhyNotTrusted' : X509_V_CODES.X509_V_CODES[verify_result]}
+
+    _verify_result_cache.put(chain_key, validation_dict)
+    return validation_dict
+
+
+def _load_certificate(b64_der):
+    # Intermediate certificates only get decoded once
+    x509 = _x509_cache.get(b64_der)
+    if x509 is None:
+        x509 = X509.load_der(b64decode(b64_der))
+        _x509_cache.put(b64_der, x509)
+    return x509
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         ConnectionRateLimiter.py
+# Purpose:      Token bucket limiting the rate of new connections, shared
+#               between all the processes and threads of a scan.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+from time import time, sleep
+from zlib import crc32
+from multiprocessing import Lock, RawArray
+
+
+class ConnectionRateLimiter:
+    """
+    Token bucket limiting the number of new connections per second, globally
+    and for each target server (IP address).
+    It lives in shared memory so it has to be created in the main process,
+    before the worker processes get started.
+    Per-target buckets are stored in a fixed-size table indexed by a hash of
+    the IP address; a collision can only make the limit stricter.
+    """
+
+    NB_TARGET_BUCKETS = 1024
+
+    def __init__(self, max_rate=None, max_rate_per_target=None):
+        """
+        @type max_rate: float
+        @param max_rate: Maximum number of connections per second to all the
+        target servers. None for no limit.
+
+        @type max_rate_per_target: float
+        @param max_rate_per_target: Maximum number of connections per second to
+        a single target server. None for no limit.
+        """
+        self._max_rate = max_rate
+        self._max_rate_per_target = max_rate_per_target
+        self._lock = Lock()
+        # Each bucket is a (nb_tokens, last_refill_time) pair.
+        # Bucket 0 is the global one; they all start full.
+        self._buckets = RawArray('d', 2 * (self.NB_TARGET_BUCKETS + 1))
+
+
+    def acquire(self, target):
+        """
+        Blocks until a new connection to the target can be opened.
+
+        @type target: (host, ip_addr, port)
+        @param target: Server that's about to be connected to.
+        """
+        wait_time = self.try_acquire(target)
+        while wait_time:
+            sleep(wait_time)
+            wait_time = self.try_acquire(target)
+
+
+    def try_acquire(self, target):
+        """
+        Takes a token for the target if one is available.
+
+        @type target: (host, ip_addr, port)
+        @param target: Server that's about to be connected to.
+
+        @rtype: float
+        @return: 0 if the connection can be opened right away, or the number of
+        seconds to wait before trying again.
+        """
+        (host, ip_addr, port) = target
+        target_index = 1 + (crc32(ip_addr) & 0xffffffff) % self.NB_TARGET_BUCKETS
+        bucket_list = [(0, self._max_rate),
+                       (target_index, self._max_rate_per_target)]
+        bucket_list = [(i, rate) for (i, rate) in bucket_list if rate]
+
+        with self._lock:
+            now = time()
+            wait_time = 0
+            for (index, rate) in bucket_list:
+                nb_tokens = self._refill(index, rate, now)
+                if nb_tokens < 1:
+                    wait_time = max(wait_time, (1 - nb_tokens) / rate)
+
+            if wait_time == 0: # Tokens are available everywhere
+                for (index, rate) in bucket_list:
+                    self._buckets[2*index] -= 1
+
+        return wait_time
+
+
+    def _refill(self, index, rate, now):
+        # The bucket can hold up to one second worth of connections
+        capacity = max(rate, 1.0)
+        elapsed = now - self._buckets[2*index + 1]
+        nb_tokens = min(capacity, self._buckets[2*index] + elapsed*rate)
+        self._buckets[2*index] = nb_tokens
+        self._buckets[2*index + 1] = now
+        return nb_tokens
@@ -42,7 +42,7 @@ class HTTPSConnection(HTTPConnection):
     """
     
     def __init__(self, host, port, ssl, strict=None, 
-                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT, ip=None):
         """
         Create a new HTTPSConnection.
 
@@ -57,9 +57,14 @@ def __init__(self, host, port, ssl, strict=None,
 
         @type timeout: int
         @param timeout: Socket timeout value.
+
+        @type ip: str
+        @param ip: IP address of the server, to avoid resolving host again.
+        The host name is still used for the HTTP Host header.
         """        
         HTTPConnection.__init__(self, host, port, strict, timeout)
         self._ssl = ssl
+        self._ip = ip
             
     
     def connect(self):
@@ -67,11 +72,12 @@ def connect(self):
         Connect to a host on a given (SSL) port.
         """
             
-        sock = socket.create_connection((self.host, self.port),
+        sock = socket.create_connection((self._ip or self.host, self.port),
                                         self.timeout)
+        # So that close() releases the socket if the handshake fails
+        self.sock = sock
         
         if self._tunnel_host:
-            self.sock = sock
             self._tunnel()
               
         # Doing something similar to ssl.wrap_socket() but with ctSSL
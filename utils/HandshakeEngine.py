@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         HandshakeEngine.py
+# Purpose:      Performs many SSL handshakes concurrently within a single
+#               thread, using non-blocking sockets and ctSSL's BIO pairs.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+import os
+import errno
+import select
+import socket
+from time import time, sleep
+from collections import deque
+
+from ctSSL import errors
+from utils.SSLyzeSSLConnection import SSLyzeSSLConnection
+
+
+# connect_ex() return values meaning the connection is in progress
+CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+                       getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+
+class HandshakeEngine:
+    """
+    Event loop performing many SSL handshakes at the same time within a single
+    thread. OpenSSL never touches the network: the engine moves bytes between
+    non-blocking sockets and each SSL object's BIO pair.
+    Only direct connections are supported, no STARTTLS or HTTP CONNECT proxy.
+    """
+
+    DEFAULT_MAX_IN_FLIGHT = 500
+
+    def __init__(self, shared_settings, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """
+        @type shared_settings: dict
+        @param shared_settings: Shared settings object.
+
+        @type max_in_flight: int
+        @param max_in_flight: Maximum number of handshakes in progress at the
+        same time.
+        """
+        self._timeout = shared_settings['timeout']
+        self._rate_limiter = shared_settings['rate_limiter']
+        self._max_in_flight = max_in_flight
+        self._handshake_q = deque()
+
+
+    @classmethod
+    def is_supported(cls, shared_settings):
+        """
+        Returns True if the engine can be used with the given settings.
+        """
+        return not (shared_settings['starttls'] or
+                    shared_settings['https_tunnel_host'])
+
+
+    def add_handshake(self, target, ssl, job):
+        """
+        Adds one client handshake to be performed when run() is called.
+
+        @type target: (host, ip_addr, port)
+        @param target: Server to connect to.
+
+        @type ssl: ctSSL.SSL
+        @param ssl: SSL object to use, created using
+        SSLyzeSSLConnection.create_ssl().
+
+        @param job: Anything that identifies the handshake. It is returned by
+        run() along with the result of the handshake.
+        """
+        self._handshake_q.append(_Handshake(target, ssl, job, self._timeout))
+
+
+    def run(self):
+        """
+        Performs all the handshakes that were added and yields their results as
+        they complete.
+
+        @rtype: generator of (job, ctSSL.SSL, Exception)
+        @return: The exception is None if the handshake was successful, an
+        SSLHandshakeRejected if the server explicitely rejected it, or the
+        exception that was raised during the handshake.
+        """
+        in_flight = {}
+
+        while self._handshake_q or in_flight:
+            # Start new handshakes if we can
+            rate_limit_wait = None
+            while self._handshake_q and len(in_flight) < self._max_in_flight:
+                handshake = self._handshake_q[0]
+                if self._rate_limiter:
+                    rate_limit_wait = self._rate_limiter.try_acquire(
+                        handshake.target)
+                    if rate_limit_wait:
+                        break
+
+                self._handshake_q.popleft()
+                try:
+                    handshake.start()
+                except Exception as e:
+                    yield handshake.finish(e)
+                else:
+                    in_flight[handshake.fileno] = handshake
+
+            if not in_flight: # Nothing to wait for but the rate limiter
+                if rate_limit_wait:
+                    sleep(rate_limit_wait)
+                continue
+
+            # Wait for network events, for the next timeout or for the next
+            # available token from the rate limiter
+            now = time()
+            poll_timeout = min([hs.deadline for hs in in_flight.values()]) - now
+            if rate_limit_wait:
+                poll_timeout = min(poll_timeout, rate_limit_wait)
+            poll_timeout = max(poll_timeout, 0)
+
+            for (fileno, is_readable, is_writable) in \
+                    _poll(in_flight.values(), poll_timeout):
+                handshake = in_flight[fileno]
+                try:
+                    if is_writable:
+                        handshake.on_writable()
+                    if is_readable and not handshake.is_done:
+                        handshake.on_readable()
+                except Exception as e:
+                    del in_flight[fileno]
+                    yield handshake.finish(e)
+                    continue
+
+                if handshake.is_done:
+                    del in_flight[fileno]
+                    yield handshake.finish(None)
+
+            # Get rid of handshakes that timed out
+            now = time()
+            for (fileno, handshake) in in_flight.items():
+                if handshake.deadline <= now:
+                    del in_flight[fileno]
+                    yield handshake.finish(socket.timeout('timed out'))
+
+
+
+class _Handshake:
+    """
+    State of one client handshake performed by the HandshakeEngine.
+    """
+
+    RECV_BUFFER_SIZE = 4096
+
+    def __init__(self, target, ssl, job, timeout):
+        self.target = target
+        self.ssl = ssl
+        self.job = job
+        self.fileno = None
+        self.deadline = None
+        self.is_done = False
+        self._timeout = timeout
+        self._sock = None
+        self._is_connecting = True
+        self._data_to_send = ''
+
+
+    def start(self):
+        """Starts connecting to the server."""
+        (host, ip_addr, port) = self.target
+        sock = socket.socket()
+        self._sock = sock
+        sock.setblocking(0)
+        self.fileno = sock.fileno()
+        self.deadline = time() + self._timeout
+
+        connect_result = sock.connect_ex((ip_addr, port))
+        if connect_result not in CONNECT_IN_PROGRESS:
+            raise socket.error(connect_result, os.strerror(connect_result))
+
+        self.ssl.set_socket(sock)
+        self.ssl.set_connect_state()
+
+
+    def wants_write(self):
+        return self._is_connecting or bool(self._data_to_send)
+
+
+    def on_writable(self):
+        if self._is_connecting: # The TCP connection is done, or failed
+            connect_result = self._sock.getsockopt(socket.SOL_SOCKET,
+                                                   socket.SO_ERROR)
+            if connect_result:
+                raise socket.error(connect_result, os.strerror(connect_result))
+            self._is_connecting = False
+            self._do_handshake_step()
+
+        elif self._data_to_send:
+            size_sent = self._send(self._data_to_send)
+            self._data_to_send = self._data_to_send[size_sent:]
+
+
+    def on_readable(self):
+        if self._is_connecting:
+            return
+        try:
+            server_data = self._sock.recv(self.RECV_BUFFER_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        if server_data == '': # EOF, handshake failed
+            raise errors.ctSSLUnexpectedEOF('Handshake failed: Unexpected EOF')
+        self.ssl.put_network_data(server_data)
+        self._do_handshake_step()
+
+
+    def finish(self, exception):
+        """
+        Closes the connection and returns the result of the handshake.
+        """
+        if exception is None:
+            self.ssl.shutdown()
+        else:
+            rejected_error = \
+                SSLyzeSSLConnection.get_handshake_rejected_error(exception)
+            if rejected_error:
+                exception = rejected_error
+
+        if self._sock:
+            self._sock.close()
+        return (self.job, self.ssl, exception)
+
+
+    def _do_handshake_step(self):
+        self.is_done = self.ssl.do_handshake_step()
+        self._data_to_send += self.ssl.get_network_data()
+        if self._data_to_send:
+            size_sent = self._send(self._data_to_send)
+            self._data_to_send = self._data_to_send[size_sent:]
+
+
+    def _send(self, data):
+        try:
+            return self._sock.send(data)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+
+
+def _poll(handshake_list, timeout):
+    """
+    Waits for network events on the handshakes' sockets.
+    Uses poll() when available, as select() is limited to FD_SETSIZE sockets.
+
+    @rtype: [(fileno, is_readable, is_writable)]
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for handshake in handshake_list:
+            if handshake.wants_write():
+                poller.register(handshake.fileno, select.POLLOUT)
+            else:
+                poller.register(handshake.fileno, select.POLLIN)
+
+        event_list = []
+        for (fileno, event) in poller.poll(timeout * 1000):
+            has_error = bool(event & (select.POLLERR | select.POLLHUP))
+            event_list.append((fileno,
+                               bool(event & select.POLLIN) or has_error,
+                               bool(event & select.POLLOUT) or has_error))
+        return event_list
+
+    else:
+        read_list = []
+        write_list = []
+        for handshake in handshake_list:
+            if handshake.wants_write():
+                write_list.append(handshake.fileno)
+            else:
+                read_list.append(handshake.fileno)
+
+        # On Windows, failed connections show up in the exception list
+        (readable, writable, failed) = select.select(read_list, write_list,
+                                                     write_list, timeout)
+        writable = set(writable) | set(failed)
+        readable = set(readable)
+        return [(fileno, fileno in readable, fileno in writable)
+                for fileno in readable | writable]
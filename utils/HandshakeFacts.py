@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         HandshakeFacts.py
+# Purpose:      Performs a single baseline SSL handshake with a target server
+#               and keeps what several plugins need to know about it.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+from utils.ctSSL import SSL_CTX, constants
+from utils.SSLyzeSSLConnection import SSLyzeSSLConnection, \
+    get_trusted_ca_store
+from utils.TargetContext import get_target_context
+
+
+class HandshakeFacts:
+    """
+    What was learned about the target server from the baseline handshake.
+    The baseline handshake is a TLS 1.0 handshake with the client hello
+    workaround, and Mozilla's CA store loaded to get the certificate's verify
+    result.
+    """
+
+    def __init__(self, ssl):
+        """
+        @type ssl: ctSSL.SSL
+        @param ssl: SSL object right after a successful baseline handshake.
+        """
+        self.certificate = ssl.get_peer_certificate()
+        self.certificate_chain = ssl.get_peer_cert_chain()
+        self.verify_result = ssl.get_verify_result()
+        self.secure_renegotiation = ssl.get_secure_renegotiation_support()
+        self.cipher = ssl.get_current_cipher()
+
+
+
+def create_baseline_connection(shared_settings, target):
+    """
+    Returns an SSLyzeSSLConnection configured for the baseline handshake,
+    not connected yet. Plugins that need to keep using the connection after
+    the handshake can call record_handshake_facts() once connected, so that
+    their handshake also serves as the baseline handshake.
+    """
+    ssl_ctx = SSL_CTX.SSL_CTX('tlsv1') # sslv23 hello will fail for specific servers such as post.craigslist.org
+    ssl_ctx.add_verify_certificates(get_trusted_ca_store())
+    ssl_ctx.set_verify(constants.SSL_VERIFY_NONE) # We'll use get_verify_result()
+    return SSLyzeSSLConnection(shared_settings, target, ssl_ctx,
+                               hello_workaround=True)
+
+
+def record_handshake_facts(target, ssl_connect):
+    """
+    Keeps the facts from a connected baseline connection in the target's
+    context, unless they were already known.
+    """
+    target_context = get_target_context(target)
+    if target_context is None or target_context.get_handshake_facts():
+        return
+    target_context.set_handshake_facts(HandshakeFacts(ssl_connect._ssl))
+
+
+def get_handshake_facts(shared_settings, target):
+    """
+    Returns the HandshakeFacts for the target. The baseline handshake is only
+    performed if no other command on this target did it already; if it
+    failed, the same exception gets raised again.
+    """
+    target_context = get_target_context(target)
+    if target_context:
+        handshake_facts = target_context.get_handshake_facts()
+        if isinstance(handshake_facts, Exception):
+            raise handshake_facts
+        elif handshake_facts:
+            return handshake_facts
+
+    ssl_connect = create_baseline_connection(shared_settings, target)
+    try: # Perform the SSL handshake
+        ssl_connect.connect()
+        handshake_facts = HandshakeFacts(ssl_connect._ssl)
+    except Exception as e:
+        handshake_facts = e
+    finally:
+        ssl_connect.close()
+
+    if target_context:
+        target_context.set_handshake_facts(handshake_facts)
+    if isinstance(handshake_facts, Exception):
+        raise handshake_facts
+    return handshake_facts
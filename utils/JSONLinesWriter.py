@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         JSONLinesWriter.py
+# Purpose:      Writes the results of a scan to a file as JSON Lines, one
+#               record per plugin result, as soon as they are available.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+import json
+
+
+class JSONLinesWriter:
+    """
+    Streams plugin results to a file, one JSON object per line. Each line is
+    flushed to disk right away so that the file can be consumed while the
+    scan is still running.
+    """
+
+    def __init__(self, json_filename):
+        self._json_file = open(json_filename, 'w')
+
+
+    def write_result(self, target, plugin_result):
+        """
+        Writes one JSON record for the result of a command on a target.
+
+        @type target: (host, ip_addr, port)
+        @param target: Server that was scanned.
+
+        @type plugin_result: PluginBase.PluginResult
+        @param plugin_result: Result of the command.
+        """
+        (host, ip_addr, port) = target
+        record = plugin_result.get_json_result()
+        record.update({'host' : host,
+                       'ip' : ip_addr,
+                       'port' : port})
+        self._json_file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._json_file.flush()
+
+
+    def close(self):
+        self._json_file.close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         ProcessPool.py
+# Purpose:      Pool of worker processes whose size follows the amount of work
+#               left to do.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+from multiprocessing import cpu_count
+
+
+def get_max_processes(nb_processes_budget=None, min_processes=1):
+    """
+    Returns the maximum number of worker processes to use.
+    If the user did not set a budget, we use one process per CPU. Most of the
+    work is network I/O so we never go below min_processes, even on a single
+    core machine.
+    """
+    if nb_processes_budget:
+        return nb_processes_budget
+
+    try:
+        nb_cpus = cpu_count()
+    except NotImplementedError:
+        nb_cpus = 1
+    return max(nb_cpus, min_processes)
+
+
+class ProcessPool:
+    """
+    Pool of worker processes that grows or shrinks depending on how many tasks
+    are still waiting to be processed.
+    The processes are created using process_factory(), and are expected to
+    terminate and put a None sentinel in their output queue whenever they get
+    a None sentinel from task_queue.
+    """
+
+    def __init__(self, process_factory, task_queue, max_processes):
+        """
+        @type process_factory: function
+        @param process_factory: Returns a new multiprocessing.Process, not
+        started yet.
+
+        @type task_queue: multiprocessing.JoinableQueue
+        @param task_queue: Queue the processes get their tasks from.
+
+        @type max_processes: int
+        @param max_processes: Upper bound on the number of processes running
+        at the same time.
+        """
+        self._process_factory = process_factory
+        self._task_queue = task_queue
+        self._max_processes = max_processes
+        self._process_list = []
+        self._nb_active = 0     # Processes that will keep getting tasks
+        self._nb_retiring = 0   # Processes that were sent a sentinel
+
+
+    def get_nb_processes(self):
+        """
+        Returns the number of processes that haven't terminated yet.
+        """
+        return self._nb_active + self._nb_retiring
+
+
+    def adjust(self, nb_pending_tasks):
+        """
+        Resizes the pool according to the number of tasks that still have to be
+        processed: no more processes than pending tasks, and no more than
+        max_processes.
+        """
+        nb_wanted = min(nb_pending_tasks, self._max_processes)
+
+        # Grow the pool
+        while self._nb_active < nb_wanted:
+            process = self._process_factory()
+            process.start()
+            self._process_list.append(process)
+            self._nb_active += 1
+
+        # Shrink the pool: the sentinels are queued after the pending tasks
+        # so one process will exit every time one task runs out
+        while self._nb_active > nb_wanted:
+            self._task_queue.put(None)
+            self._nb_active -= 1
+            self._nb_retiring += 1
+
+
+    def process_exited(self):
+        """
+        Should be called every time a process acknowledges its sentinel.
+        """
+        self._nb_retiring -= 1
+
+        # Join the processes that already terminated so that they don't stay
+        # around as zombies until the end of the scan
+        running_process_list = []
+        for process in self._process_list:
+            if process.is_alive():
+                running_process_list.append(process)
+            else:
+                process.join()
+        self._process_list = running_process_list
+
+
+    def join(self):
+        """
+        Waits for the remaining processes to terminate. They must all have
+        acknowledged their sentinel already.
+        """
+        for process in self._process_list:
+            process.join()
+        self._process_list = []
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         ResultCache.py
+# Purpose:      On-disk cache of plugin results, so that unchanged servers
+#               don't have to be scanned again.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+import sqlite3
+import json
+from time import time
+from hashlib import sha1
+
+from plugins.PluginBase import PluginResult
+
+
+# Settings that have no effect on the results of the plugins
+NON_RESULT_SETTINGS = ['xml_file', 'json_file', 'targets_in', 'cache_file', 'cache_ttl',
+                       'nb_processes', 'max_rate', 'max_rate_per_target',
+                       'rate_limiter', 'group_by_target', 'skip_discovery',
+                       'checkpoint_file', 'resume', 'coordinator', 'agent',
+                       'authkey']
+
+
+def get_settings_hash(shared_settings, available_commands):
+    """
+    Returns a hash of the settings that can change a plugin's result. The
+    commands are not part of it, as each result is only tied to its own
+    command.
+    """
+    settings_list = [(key, value) for (key, value)
+                     in shared_settings.iteritems()
+                     if key not in NON_RESULT_SETTINGS
+                     and key not in available_commands]
+    return sha1(repr(sorted(settings_list))).hexdigest()
+
+
+class ResultCache:
+    """
+    SQLite cache of plugin results, keyed by target, command, command
+    argument and by a hash of the settings that can change a plugin's result.
+    Entries expire after ttl seconds; when the cache gets too big, the oldest
+    entries get evicted first.
+    Only used within the main process.
+    """
+
+    DEFAULT_MAX_ENTRIES = 100000
+
+    def __init__(self, cache_file, ttl, shared_settings, available_commands,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        @type cache_file: str
+        @param cache_file: Path to the SQLite database. Created if needed.
+
+        @type ttl: int
+        @param ttl: Number of seconds after which a result has to be scanned
+        again.
+
+        @type shared_settings: dict
+        @param shared_settings: Shared settings object.
+
+        @type available_commands: dict
+        @param available_commands: Commands implemented by the plugins. They
+        are not part of the settings hash, as each result is only tied to its
+        own command.
+
+        @type max_entries: int
+        @param max_entries: Maximum number of results kept in the cache.
+        """
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._available_commands = available_commands
+        self._served_keys = set() # Results that were replayed in this scan
+        self._nb_served = 0
+
+        self._settings_hash = get_settings_hash(shared_settings,
+                                                available_commands)
+
+        self._db = sqlite3.connect(cache_file)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS plugin_results (key TEXT PRIMARY KEY, '
+            'timestamp REAL, json_result TEXT)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS plugin_results_timestamp ON '
+            'plugin_results (timestamp)')
+        self._purge()
+
+
+    def get(self, target, command, args):
+        """
+        Returns the cached PluginResult for the task, or None if there's no
+        valid result in the cache.
+        """
+        key = self._get_key(target, command, args)
+        row = self._db.execute(
+            'SELECT json_result FROM plugin_results '
+            'WHERE key = ? AND timestamp >= ?',
+            (key, time() - self._ttl)).fetchone()
+        if row is None:
+            return None
+
+        self._served_keys.add(key)
+        self._nb_served += 1
+        return PluginResult.from_json(json.loads(row[0]),
+                                      self._available_commands)
+
+
+    def get_nb_served(self):
+        """
+        Returns the number of results that came from the cache.
+        """
+        return self._nb_served
+
+
+    def was_served(self, target, command, args):
+        """
+        Returns True if the result for this task came from the cache.
+        """
+        return self._get_key(target, command, args) in self._served_keys
+
+
+    def put(self, target, command, args, plugin_result):
+        """
+        Stores a fresh PluginResult in the cache. Results coming from the cache
+        and results of tasks that raised an exception are not stored.
+        """
+        key = self._get_key(target, command, args)
+        if key in self._served_keys:
+            return
+
+        if plugin_result.error:
+            return
+
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO plugin_results VALUES (?, ?, ?)',
+                (key, time(), json.dumps(plugin_result.get_json_result())))
+
+
+    def close(self):
+        self._purge()
+        self._db.close()
+
+
+    def _get_key(self, target, command, args):
+        (host, ip_addr, port) = target
+        return sha1(repr((host, ip_addr, port, command, args,
+                          self._settings_hash))).hexdigest()
+
+
+    def _purge(self):
+        """
+        Removes expired entries, then the oldest entries if there are too many.
+        """
+        with self._db:
+            self._db.execute('DELETE FROM plugin_results WHERE timestamp < ?',
+                             (time() - self._ttl,))
+            self._db.execute(
+                'DELETE FROM plugin_results WHERE key IN (SELECT key FROM '
+                'plugin_results ORDER BY timestamp DESC LIMIT -1 OFFSET ?)',
+                (self._max_entries,))
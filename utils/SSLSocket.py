@@ -113,20 +113,14 @@ def recv(self, buflen=1024, flags=0):
     
 
     def recv_into(self, buffer, nbytes=None, flags=0):
-        if buffer and (nbytes is None):
-            nbytes = len(buffer)
-        elif nbytes is None:
-            nbytes = 1024
-
         if flags != 0:
             raise ValueError(
               "non-zero flags not allowed in calls to recv_into() on %s" %
               self.__class__)
-            
-            tmp_buffer = self.ssl.read(nbytes)
-            v = len(tmp_buffer)
-            buffer[:v] = tmp_buffer
-            return v
+
+        # Never read more than what fits in the caller's buffer
+        nbytes = min(nbytes or len(buffer), len(buffer))
+        return self.ssl.read_into(buffer, nbytes)
 
 
     def recvfrom(self, buflen=1024, flags=0):
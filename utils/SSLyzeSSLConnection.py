@@ -26,11 +26,34 @@
 #   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
 #-------------------------------------------------------------------------------
 
+import os
+import sys
 import socket
 
-from ctSSL import SSL, SSL_CTX, errors
+from ctSSL import SSL, SSL_CTX, X509, constants, errors
 from utils.HTTPSConnection import HTTPSConnection
-from utils.StartTLS import SMTPConnection, XMPPConnection
+from utils.StartTLS import SMTPConnection, XMPPConnection, SSLHandshakeError
+from utils.TargetContext import get_target_context
+
+
+TRUSTED_CA_STORE = os.path.join(sys.path[0], 'mozilla_cacert.pem')
+
+# Certificates from TRUSTED_CA_STORE, once loaded within this process
+_trusted_ca_list = None
+
+
+def get_trusted_ca_store():
+    """
+    Returns the certificates from TRUSTED_CA_STORE, to be given to
+    SSL_CTX.add_verify_certificates(). The file only gets parsed the first
+    time within each process.
+
+    @rtype: [ctSSL.X509.X509]
+    """
+    global _trusted_ca_list
+    if _trusted_ca_list is None:
+        _trusted_ca_list = X509.load_pem_file(TRUSTED_CA_STORE)
+    return _trusted_ca_list
 
 
 class SSLHandshakeRejected(Exception):
@@ -78,7 +101,8 @@ class SSLyzeSSLConnection:
     
 
 
-    def __init__(self, shared_settings, target, ssl_ctx,hello_workaround=False):
+    def __init__(self, shared_settings, target, ssl_ctx,hello_workaround=False,
+                 compression=False):
         """
         Read the shared_settings object shared between all the plugins and 
         configure the SSL_CTX and SSL objects accordingly.
@@ -94,45 +118,28 @@ def __init__(self, shared_settings, target, ssl_ctx,hello_workaround=False):
         
         @type hello_workaround: bool
         @param hello_workaround: Enable client hello workaround.       
+
+        @type compression: bool
+        @param compression: Offer Zlib compression. ctSSL_initialize() must
+        have been called with zlib=True.
         """
     
         timeout = shared_settings['timeout']
         (host, ip_addr, port) = target
-        if hello_workaround:
-            ssl_ctx.set_cipher_list(self.SSL_HELLO_WORKAROUND_CIPHERS)
-        
-        # Create the SSL object
-        ssl = SSL.SSL(ssl_ctx)
-
-        # Load client certificate and private key in the SSL object
-        if shared_settings['cert']:
-            if shared_settings['certform'] is 'DER':
-                ssl.use_certificate_file(shared_settings['cert'],
-                                         constants.SSL_FILETYPE_ASN1)
-            else:
-                ssl.use_certificate_file(shared_settings['cert'],
-                                         constants.SSL_FILETYPE_PEM)
-    
-            if shared_settings['keyform'] is 'DER':
-                ssl.use_PrivateKey_file(shared_settings['key'],
-                                        constants.SSL_FILETYPE_ASN1)
-            else:
-                ssl.use_PrivateKey_file(shared_settings['key'],
-                                        constants.SSL_FILETYPE_PEM)
-    
-            ssl.check_private_key()
-            
+        ssl = self.create_ssl(shared_settings, ssl_ctx, hello_workaround,
+                              compression)
         
         # Create the proper SMTP / XMPP / HTTPS connection
         if shared_settings['starttls'] == 'smtp':
-            ssl_connection = SMTPConnection(host, port, ssl, timeout)
+            ssl_connection = SMTPConnection(host, port, ssl, timeout, ip_addr)
         elif shared_settings['starttls'] == 'xmpp':
             if shared_settings['xmpp_to']:
                 xmpp_to = shared_settings['xmpp_to']
             else:
                 xmpp_to = host
                 
-            ssl_connection = XMPPConnection(host, port, ssl, timeout, xmpp_to)   
+            ssl_connection = XMPPConnection(host, port, ssl, timeout, xmpp_to,
+                                            ip_addr)   
                  
         elif shared_settings['https_tunnel_host']:
             # Using an HTTP CONNECT proxy to tunnel SSL traffic
@@ -142,7 +149,9 @@ def __init__(self, shared_settings, target, ssl_ctx,hello_workaround=False):
                                             timeout=timeout)
             ssl_connection.set_tunnel(host, port)
         else:
-            ssl_connection = HTTPSConnection(host, port, ssl, timeout=timeout)
+            # Dial the IP address found when discovering the targets
+            ssl_connection = HTTPSConnection(host, port, ssl, timeout=timeout,
+                                             ip=ip_addr)
             
         
         # All done
@@ -150,6 +159,93 @@ def __init__(self, shared_settings, target, ssl_ctx,hello_workaround=False):
         self._ssl_ctx = ssl_ctx
         self._ssl = ssl
         self._shared_settings = shared_settings
+        self._target = target
+
+
+    @classmethod
+    def create_ssl(cls, shared_settings, ssl_ctx, hello_workaround=False,
+                   compression=False):
+        """
+        Create an SSL object configured according to the shared_settings
+        object, without any connection attached to it.
+
+        @type shared_settings: dict
+        @param shared_settings: Shared settings object.
+
+        @type ssl_ctx: ctSSL.SSL_CTX
+        @param ssl_ctx: SSL_CTX object for the SSL connection.
+        
+        @type hello_workaround: bool
+        @param hello_workaround: Enable client hello workaround.
+
+        @type compression: bool
+        @param compression: Offer Zlib compression.
+
+        @rtype: ctSSL.SSL
+        @return: The new SSL object.
+        """
+        if hello_workaround:
+            ssl_ctx.set_cipher_list(cls.SSL_HELLO_WORKAROUND_CIPHERS)
+
+        # Once a compression test enabled Zlib, OpenSSL offers it in every
+        # handshake of the process; only do it when asked to
+        if not compression:
+            ssl_ctx.set_options(constants.SSL_OP_NO_COMPRESSION)
+        
+        # Create the SSL object
+        ssl = SSL.SSL(ssl_ctx)
+
+        # Load client certificate and private key in the SSL object
+        if shared_settings['cert']:
+            if shared_settings['certform'] == 'DER':
+                ssl.use_certificate_file(shared_settings['cert'],
+                                         constants.SSL_FILETYPE_ASN1)
+            else:
+                ssl.use_certificate_file(shared_settings['cert'],
+                                         constants.SSL_FILETYPE_PEM)
+    
+            if shared_settings['keyform'] == 'DER':
+                ssl.use_PrivateKey_file(shared_settings['key'],
+                                        constants.SSL_FILETYPE_ASN1)
+            else:
+                ssl.use_PrivateKey_file(shared_settings['key'],
+                                        constants.SSL_FILETYPE_PEM)
+    
+            ssl.check_private_key()
+
+        return ssl
+
+
+    @classmethod
+    def get_handshake_rejected_error(cls, e):
+        """
+        Look at an exception raised during a handshake, to figure out whether
+        the server explicitely rejected the handshake.
+
+        @type e: Exception
+        @param e: Exception raised during the handshake.
+
+        @rtype: SSLHandshakeRejected
+        @return: The corresponding SSLHandshakeRejected exception, or None if
+        the handshake was not explicitely rejected.
+        """
+        if isinstance(e, socket.error):
+            for error_msg in cls.HANDSHAKE_REJECTED_SOCKET_ERRORS.keys():
+                if error_msg in str(e.args):
+                    return SSLHandshakeRejected('TCP - ' + cls.HANDSHAKE_REJECTED_SOCKET_ERRORS[error_msg])
+            
+        elif isinstance(e, errors.ctSSLUnexpectedEOF): # Unexpected EOF
+            return SSLHandshakeRejected('TCP - Received FIN')
+    
+        elif isinstance(e, errors.SSLErrorSSL):    
+            for error_msg in cls.HANDSHAKE_REJECTED_SSL_ERRORS.keys():
+                if error_msg in str(e.args):
+                    return SSLHandshakeRejected('TLS Alert - ' + cls.HANDSHAKE_REJECTED_SSL_ERRORS[error_msg])
+                    
+        elif isinstance(e, errors.SSLErrorZeroReturn): # Connection abruptly closed by peer
+            return SSLHandshakeRejected('TCP - Received RST')
+
+        return None
             
             
     def connect(self):
@@ -161,26 +257,43 @@ def connect(self):
         @raise SSLHandshakeRejected: The handshake was explicitely rejected
         by the other side.
         """
+        # Wait for our turn if the rate of connections is limited
+        rate_limiter = self._shared_settings['rate_limiter']
+        if rate_limiter:
+            rate_limiter.acquire(self._target)
+
+        target_context = get_target_context(self._target)
+        # Without --skip_discovery the target was already found to be up; a
+        # failed connection must not get it cancelled
+        probe_reachability = target_context and \
+                             self._shared_settings['skip_discovery']
         try: 
             self._ssl_connection.connect()
-        
-        except socket.error as e:
-            for error_msg in self.HANDSHAKE_REJECTED_SOCKET_ERRORS.keys():
-                if error_msg in str(e.args):
-                    raise SSLHandshakeRejected('TCP - ' + self.HANDSHAKE_REJECTED_SOCKET_ERRORS[error_msg])
+
+        except SSLHandshakeError as e: # STARTTLS negotiation failed
+            if probe_reachability:
+                target_context.set_reachable(False, str(e))
             raise
-            
-        except errors.ctSSLUnexpectedEOF as e: # Unexpected EOF
-            raise SSLHandshakeRejected('TCP - Received FIN')
-    
-        except errors.SSLErrorSSL as e:    
-            for error_msg in self.HANDSHAKE_REJECTED_SSL_ERRORS.keys():
-                if error_msg in str(e.args):
-                    raise SSLHandshakeRejected('TLS Alert - ' + self.HANDSHAKE_REJECTED_SSL_ERRORS[error_msg])
-            raise # Unknown SSL error if we get there
-                    
-        except errors.SSLErrorZeroReturn as e: # Connection abruptly closed by peer
-            raise SSLHandshakeRejected('TCP - Received RST')    
+        
+        except (socket.error, errors.ctSSLError) as e:
+            if probe_reachability:
+                # The socket is only there if the TCP connection went through
+                if self._ssl_connection.sock is None:
+                    target_context.set_reachable(
+                        False, 'Could not connect - ' + str(e))
+                else:
+                    target_context.set_reachable(True)
+
+            handshake_rejected = self.get_handshake_rejected_error(e)
+            if handshake_rejected:
+                raise handshake_rejected
+            raise # Unknown error if we get there
+
+        # Let the other commands on this target know the protocol works
+        if target_context:
+            target_context.set_reachable(True)
+            target_context.set_protocol_supported(
+                self._ssl_ctx.get_ssl_version())
 
 
     def close(self):
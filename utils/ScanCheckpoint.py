@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         ScanCheckpoint.py
+# Purpose:      Journal of the results of a scan, so that an interrupted scan
+#               can be resumed without scanning the same targets again.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+import json
+
+from plugins.PluginBase import PluginResult
+from utils.ResultCache import get_settings_hash
+
+
+class ScanCheckpoint:
+    """
+    Appends every plugin result to a journal file as soon as it comes in,
+    one JSON object per line. The first line holds a hash of the scan
+    settings.
+    When resuming, the results found in the journal are replayed instead of
+    being scanned again, as long as the settings didn't change. Results of
+    tasks that raised an exception are scanned again.
+    Same interface as ResultCache; only used within the main process.
+    """
+
+    def __init__(self, checkpoint_file, shared_settings, available_commands,
+                 resume=False):
+        """
+        @type checkpoint_file: str
+        @param checkpoint_file: Path to the journal file.
+
+        @type shared_settings: dict
+        @param shared_settings: Shared settings object.
+
+        @type available_commands: dict
+        @param available_commands: Commands implemented by the plugins.
+
+        @type resume: bool
+        @param resume: Load the results already in the journal and keep
+        appending to it. Otherwise, the journal gets overwritten.
+
+        @raise ValueError: The journal was written with different settings.
+        """
+        self._available_commands = available_commands
+        self._settings_hash = get_settings_hash(shared_settings,
+                                                available_commands)
+        self._journal_dict = {} # Results found in the journal
+        self._served_keys = set()
+        self._nb_served = 0
+
+        if resume:
+            is_last_line_complete = self._load(checkpoint_file)
+            self._journal_file = open(checkpoint_file, 'a')
+            if not is_last_line_complete: # Don't append to a truncated line
+                self._journal_file.write('\n')
+        else:
+            self._journal_file = open(checkpoint_file, 'w')
+            self._write_line({'settingsHash' : self._settings_hash})
+
+
+    def get(self, target, command, args):
+        """
+        Returns the PluginResult found in the journal for the task, or None.
+        """
+        key = self._get_key(target, command, args)
+        json_result = self._journal_dict.get(key)
+        if json_result is None:
+            return None
+
+        self._served_keys.add(key)
+        self._nb_served += 1
+        return PluginResult.from_json(json_result, self._available_commands)
+
+
+    def get_nb_served(self):
+        """
+        Returns the number of results that came from the journal.
+        """
+        return self._nb_served
+
+
+    def was_served(self, target, command, args):
+        """
+        Returns True if the result for this task came from the journal.
+        """
+        return self._get_key(target, command, args) in self._served_keys
+
+
+    def put(self, target, command, args, plugin_result):
+        """
+        Appends a fresh PluginResult to the journal.
+        """
+        key = self._get_key(target, command, args)
+        if key in self._served_keys:
+            return
+
+        (host, ip_addr, port) = target
+        self._write_line({'host' : host,
+                          'port' : port,
+                          'result' : plugin_result.get_json_result()})
+
+
+    def close(self):
+        self._journal_file.close()
+
+
+    def _get_key(self, target, command, args):
+        # The IP address may change between two runs
+        (host, ip_addr, port) = target
+        return (host, port, command, args)
+
+
+    def _write_line(self, record):
+        # Flushed right away, so that nothing is lost if the scan dies
+        self._journal_file.write(json.dumps(record) + '\n')
+        self._journal_file.flush()
+
+
+    def _load(self, checkpoint_file):
+        """
+        Loads the results from the journal. Returns False if the last line
+        was cut short.
+        """
+        with open(checkpoint_file) as journal:
+            line = journal.readline()
+            try:
+                header = json.loads(line)
+            except ValueError:
+                raise ValueError('Not a valid checkpoint file.')
+            if header.get('settingsHash') != self._settings_hash:
+                raise ValueError('The checkpoint file was written with '
+                                 'different scan settings.')
+
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError: # Last line was cut short when the scan died
+                    continue
+                json_result = record['result']
+                if json_result['error']:
+                    continue
+                # Unicode strings from json have the same hash as str ones
+                key = self._get_key((record['host'], None, record['port']),
+                                    json_result['command'],
+                                    json_result['argument'])
+                self._journal_dict[key] = json_result
+
+        return line.endswith('\n')
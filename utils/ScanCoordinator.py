@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         ScanCoordinator.py
+# Purpose:      Shares the work units of a scan over TCP, so that agents
+#               running on other hosts can process some of them.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+from threading import Thread, Lock, Event
+from time import time
+from Queue import Empty
+from multiprocessing.managers import BaseManager
+
+from utils.discover_targets import is_target_valid
+
+
+# Settings that only make sense on the coordinator's host, such as local
+# files and the rate limiter, which lives in shared memory; agents use their
+# own values for them
+COORDINATOR_ONLY_SETTINGS = ['rate_limiter', 'cert', 'certform', 'key',
+                             'keyform', 'keypass', 'xml_file', 'json_file',
+                             'targets_in', 'cache_file', 'cache_ttl',
+                             'checkpoint_file', 'resume', 'coordinator',
+                             'agent', 'authkey', 'nb_processes']
+
+HEARTBEAT_INTERVAL = 10 # Seconds between two heartbeats of an agent
+AGENT_TIMEOUT = 6 * HEARTBEAT_INTERVAL # Agent considered gone after that
+POLL_INTERVAL = 1 # Seconds take_task() waits on the task queue at a time
+
+
+class WorkDispatcher:
+    """
+    Hands the coordinator's work units to the agents and keeps track of which
+    agent is working on which unit. The units of an agent that stopped
+    sending heartbeats are put back in the task queue, and whatever that
+    agent sends afterwards for them is dropped.
+    Agents never see the sentinels of the coordinator's own processes.
+    """
+
+    def __init__(self, task_queue, result_queue):
+        self._task_queue = task_queue
+        self._result_queue = result_queue
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._local_only = False # Set once the process pool started shrinking
+        self._next_unit_id = 0
+        self._assigned_units = {} # unit_id => (agent_id, task)
+        self._last_seen = {} # agent_id => time of its last call
+
+
+    def take_task(self, agent_id):
+        """
+        Blocks until a work unit is available for the agent.
+
+        @rtype: (int, task)
+        @return: The unit's id and the task, or None if the scan is over.
+        """
+        self.heartbeat(agent_id)
+        while not self._stop_event.is_set():
+            if self._local_only:
+                self._stop_event.wait(POLL_INTERVAL)
+                continue
+
+            try:
+                task = self._task_queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+            # Delivery to the agent is tracked here instead
+            self._task_queue.task_done()
+
+            if task == None:
+                # The process pool is shrinking, meaning the coordinator's
+                # processes can handle the remaining tasks. Give the sentinel
+                # back to them and stop taking tasks from their queue.
+                self._task_queue.put(None)
+                self._local_only = True
+                continue
+
+            with self._lock:
+                unit_id = self._next_unit_id
+                self._next_unit_id += 1
+                self._assigned_units[unit_id] = (agent_id, task)
+                self._last_seen[agent_id] = time()
+            return (unit_id, task)
+
+        return None
+
+
+    def task_done(self, agent_id, unit_id, result_list):
+        """
+        Sends the results of a work unit to the coordinator.
+
+        @rtype: bool
+        @return: False if the unit had already been given to someone else, in
+        which case the results are dropped.
+        """
+        with self._lock:
+            self._last_seen[agent_id] = time()
+            (assigned_agent_id, task) = \
+                self._assigned_units.get(unit_id, (None, None))
+            if assigned_agent_id != agent_id:
+                return False
+            del self._assigned_units[unit_id]
+
+        for result in result_list:
+            self._result_queue.put(result)
+        return True
+
+
+    def heartbeat(self, agent_id):
+        """
+        Lets the coordinator know the agent is still there.
+        """
+        with self._lock:
+            self._last_seen[agent_id] = time()
+
+
+    def requeue_lost_units(self):
+        """
+        Puts the work units of the agents that didn't send a heartbeat within
+        AGENT_TIMEOUT back in the task queue.
+        """
+        min_last_seen = time() - AGENT_TIMEOUT
+        with self._lock:
+            lost_agent_set = set([agent_id for (agent_id, last_seen)
+                                  in self._last_seen.iteritems()
+                                  if last_seen < min_last_seen])
+            for agent_id in lost_agent_set:
+                del self._last_seen[agent_id]
+
+            requeued_list = []
+            for (unit_id, (agent_id, task)) in self._assigned_units.items():
+                if agent_id in lost_agent_set:
+                    del self._assigned_units[unit_id]
+                    requeued_list.append(task)
+
+        # The coordinator still counts them as pending, so it keeps enough
+        # processes around to take them
+        for task in requeued_list:
+            self._task_queue.put(task)
+
+
+    def stop(self):
+        """
+        Tells the agents the scan is over.
+        """
+        self._stop_event.set()
+
+
+    def _monitor_agents(self):
+        while not self._stop_event.is_set():
+            self._stop_event.wait(HEARTBEAT_INTERVAL)
+            self.requeue_lost_units()
+
+
+
+class ScanManager(BaseManager):
+    """
+    Exposes the coordinator's WorkDispatcher and shared settings.
+    """
+    pass
+
+
+class AgentManager(BaseManager):
+    """
+    Agent side of ScanManager. Kept separate so that the agent's proxies
+    don't end up in a ScanManager served by the same process.
+    """
+    pass
+
+
+def parse_address(address):
+    """
+    Turns a 'host:port' string into a (host, port) tuple, or raises
+    ValueError if the port is missing or invalid.
+    """
+    (host, port) = is_target_valid(address, None)
+    if port is None:
+        raise ValueError('No port specified.')
+    return (host, port)
+
+
+def start_coordinator(address, authkey, task_queue, result_queue,
+                      shared_settings):
+    """
+    Starts serving work units to the agents, in threads of the current
+    process. The threads go away with the process, which disconnects the
+    agents.
+
+    @type address: str
+    @param address: 'host:port' to listen on.
+
+    @type authkey: str
+    @param authkey: Secret the agents have to know in order to connect.
+
+    @rtype: WorkDispatcher
+    @return: The dispatcher; call its stop() method once the scan is over.
+    """
+    agent_settings = dict([(key, value) for (key, value)
+                           in shared_settings.iteritems()
+                           if key not in COORDINATOR_ONLY_SETTINGS])
+    dispatcher = WorkDispatcher(task_queue, result_queue)
+
+    # register() works on the class; each coordinator gets its own
+    class CoordinatorManager(ScanManager):
+        pass
+    CoordinatorManager.register('get_dispatcher', callable=lambda: dispatcher)
+    CoordinatorManager.register('get_shared_settings',
+                                callable=lambda: agent_settings)
+
+    manager = CoordinatorManager(address=parse_address(address),
+                                 authkey=authkey)
+    server = manager.get_server()
+    for thread_target in [server.serve_forever, dispatcher._monitor_agents]:
+        thread = Thread(target=thread_target)
+        thread.daemon = True
+        thread.start()
+    return dispatcher
+
+
+def connect_to_coordinator(address, authkey):
+    """
+    Connects to a coordinator and returns the AgentManager to get the
+    WorkDispatcher and the shared settings from.
+
+    @type address: str
+    @param address: 'host:port' of the coordinator.
+
+    @type authkey: str
+    @param authkey: Secret shared with the coordinator.
+
+    @raise socket.error: The coordinator could not be reached.
+    @raise multiprocessing.AuthenticationError: Wrong authkey.
+    """
+    # register() works on the class; each connection gets its own
+    class ConnectionManager(AgentManager):
+        pass
+    ConnectionManager.register('get_dispatcher')
+    ConnectionManager.register('get_shared_settings')
+
+    manager = ConnectionManager(address=parse_address(address),
+                                authkey=authkey)
+    manager.connect()
+    return manager
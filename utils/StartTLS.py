@@ -33,10 +33,12 @@ class SSLHandshakeError(Exception):
 
 class SMTPConnection():
     
-    def __init__(self, host, port, ssl, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    def __init__(self, host, port, ssl, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 ip=None):
         
         self.ssl = ssl
         self.host = host
+        self.ip = ip # Avoids resolving host again if given
         self.port = port
         self.timeout = timeout
         self.sock = None
@@ -48,7 +50,7 @@ def connect(self):
         and perform the SSL handshake.
         """
         
-        sock = socket.create_connection((self.host, self.port),
+        sock = socket.create_connection((self.ip or self.host, self.port),
                                         self.timeout)
         self.sock = sock
 
@@ -86,10 +88,11 @@ class XMPPConnection():
     xmpp_starttls = "<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>"
     
     def __init__(self, host, port, ssl, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, 
-                 xmpp_to=None):
+                 xmpp_to=None, ip=None):
         
         self.ssl = ssl
         self.host = host
+        self.ip = ip # Avoids resolving host again if given
         self.port = port
         self.timeout = timeout
         self.sock = None
@@ -105,7 +108,7 @@ def connect(self):
         and perform the SSL handshake.
         """
         
-        sock = socket.create_connection((self.host, self.port),
+        sock = socket.create_connection((self.ip or self.host, self.port),
                                         self.timeout)
         self.sock = sock
         
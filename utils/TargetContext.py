@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         TargetContext.py
+# Purpose:      Keeps track of what was learned about a target server while
+#               a worker process is running all the commands for that server.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+# Contexts of the targets currently being scanned within this process
+_target_context_dict = {}
+
+
+class TargetContext:
+    """
+    Facts about one target server that plugins can share while they process
+    the commands of the same work unit, so they don't have to find them out
+    again.
+    """
+
+    def __init__(self, target):
+        """
+        @type target: (host, ip_addr, port)
+        @param target: Server the context is about.
+        """
+        self.target = target
+        self._supported_protocol_set = set()
+        self._handshake_facts = None
+        self._is_reachable = None
+        self._unreachable_reason = None
+
+
+    def set_protocol_supported(self, ssl_version):
+        """
+        Records that a handshake was successful with the given SSL version.
+
+        @type ssl_version: str
+        @param ssl_version: SSL version, as given to SSL_CTX().
+        """
+        self._supported_protocol_set.add(ssl_version)
+
+
+    def is_protocol_supported(self, ssl_version):
+        """
+        Returns True if a handshake was already successful with the given SSL
+        version, False if we don't know.
+        """
+        return ssl_version in self._supported_protocol_set
+
+
+    def set_reachable(self, is_reachable, reason=None):
+        """
+        Records whether a connection to the target could be established.
+        Once a connection went through, the target is considered reachable
+        even if later connections fail.
+
+        @type is_reachable: bool
+        @param is_reachable: True if the TCP connection (and the STARTTLS
+        negotiation, if any) went through.
+
+        @type reason: str
+        @param reason: Why the target could not be reached.
+        """
+        if self._is_reachable:
+            return
+        self._is_reachable = is_reachable
+        self._unreachable_reason = None if is_reachable else reason
+
+
+    def is_reachable(self):
+        """
+        Returns True if a connection to the target went through, False if
+        the first attempt failed, and None if no connection was attempted.
+        """
+        return self._is_reachable
+
+
+    def get_unreachable_reason(self):
+        """
+        Returns why the target could not be reached, or None.
+        """
+        return self._unreachable_reason
+
+
+    def set_handshake_facts(self, handshake_facts):
+        """
+        Keeps the result of the baseline handshake.
+
+        @type handshake_facts: HandshakeFacts.HandshakeFacts or Exception
+        @param handshake_facts: Facts about the handshake, or the exception
+        that was raised when attempting it.
+        """
+        self._handshake_facts = handshake_facts
+
+
+    def get_handshake_facts(self):
+        """
+        Returns the result of the baseline handshake, or None if it wasn't
+        performed yet.
+        """
+        return self._handshake_facts
+
+
+
+def open_target_context(target):
+    """
+    Creates the context for a target whose commands are about to be
+    processed.
+    """
+    _target_context_dict[target] = TargetContext(target)
+    return _target_context_dict[target]
+
+
+def close_target_context(target):
+    """
+    Forgets about a target once all its commands have been processed.
+    """
+    _target_context_dict.pop(target, None)
+
+
+def get_target_context(target):
+    """
+    Returns the context of a target, or None if no context was opened for
+    that target in this process.
+    """
+    return _target_context_dict.get(target)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         XMLStreamWriter.py
+# Purpose:      Writes the XML output of a scan to a file one target at a
+#               time, instead of keeping the whole document in memory.
+#
+# Author:       alban
+#
+# Copyright:    2012 SSLyze developers
+#
+#   SSLyze is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   SSLyze is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with SSLyze.  If not, see <http://www.gnu.org/licenses/>.
+#-------------------------------------------------------------------------------
+
+from tempfile import TemporaryFile
+from xml.etree.ElementTree import tostring
+from xml.sax.saxutils import quoteattr
+
+
+INDENT = '  '
+
+
+class XMLStreamWriter:
+    """
+    Streams the XML output document to a file. Each target's element is
+    pretty-printed and flushed to a temporary file as soon as it is written,
+    so that it is not kept in memory. The targets are copied to the document
+    sorted by host and port when the writer is closed, so that the output
+    does not depend on the order in which the scans completed.
+    Attributes whose value is only known at the end of the scan (such as
+    totalScanTime) are written as fixed-width placeholders that get
+    overwritten when the writer is closed.
+    """
+
+    # Room reserved for a late attribute: name="value" plus padding
+    LATE_ATTR_WIDTH = 48
+
+    def __init__(self, xml_filename, document_attr, results_attr,
+                 late_results_attr_list=()):
+        """
+        @type xml_filename: str
+        @param xml_filename: File to write the XML document to.
+
+        @type document_attr: dict
+        @param document_attr: Attributes of the <document> element.
+
+        @type results_attr: dict
+        @param results_attr: Attributes of the <results> element.
+
+        @type late_results_attr_list: [str]
+        @param late_results_attr_list: Attributes of the <results> element that
+        will be given to close().
+        """
+        self._xml_file = open(xml_filename, 'wb')
+        self._late_attr_offsets = {}
+        self._target_file = TemporaryFile()
+        self._target_index = [] # (host, port, offset, length) for each target
+
+        self._xml_file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self._xml_file.write('<document' + _format_attr(document_attr) + '>\n')
+        self._xml_file.write(INDENT + '<results' + _format_attr(results_attr))
+        for attr_name in late_results_attr_list:
+            self._xml_file.write(' ')
+            self._late_attr_offsets[attr_name] = self._xml_file.tell()
+            self._xml_file.write(self._format_late_attr(attr_name, ''))
+        self._xml_file.write('>\n')
+        self._xml_file.flush()
+
+
+    def write_target(self, target_xml):
+        """
+        Pretty-prints one <target> element to the temporary file.
+
+        @type target_xml: xml.etree.ElementTree.Element
+        """
+        _indent(target_xml, 2)
+        target_xml.tail = None
+        target_str = INDENT*2 + tostring(target_xml, encoding='utf-8') + '\n'
+
+        self._target_file.seek(0, 2)
+        self._target_index.append((target_xml.attrib['host'],
+                                   int(target_xml.attrib['port']),
+                                   self._target_file.tell(), len(target_str)))
+        self._target_file.write(target_str)
+        self._target_file.flush()
+
+
+    def close(self, late_results_attr={}):
+        """
+        Writes the targets sorted by host and port, then closes the XML
+        document and fills in the late attributes.
+
+        @type late_results_attr: dict
+        @param late_results_attr: Values of the late attributes of the
+        <results> element.
+        """
+        self._target_index.sort()
+        for (host, port, offset, length) in self._target_index:
+            self._target_file.seek(offset)
+            self._xml_file.write(self._target_file.read(length))
+        self._target_file.close()
+
+        self._xml_file.write(INDENT + '</results>\n</document>\n')
+        for (attr_name, attr_value) in late_results_attr.iteritems():
+            self._xml_file.seek(self._late_attr_offsets[attr_name])
+            self._xml_file.write(self._format_late_attr(attr_name, attr_value))
+        self._xml_file.close()
+
+
+    def _format_late_attr(self, attr_name, attr_value):
+        # Whitespace after an attribute is valid XML; use it as padding
+        attr_str = attr_name + '=' + quoteattr(str(attr_value))
+        if len(attr_str) > self.LATE_ATTR_WIDTH:
+            raise ValueError('Value too long for ' + attr_name)
+        return attr_str.ljust(self.LATE_ATTR_WIDTH)
+
+
+
+def _format_attr(attr_dict):
+    # Sorted by name, as minidom used to do
+    attr_str = ''
+    for (attr_name, attr_value) in sorted(attr_dict.iteritems()):
+        attr_str += ' ' + attr_name + '=' \
+            + quoteattr(unicode(attr_value)).encode('utf-8')
+    return attr_str
+
+
+def _indent(elem, level=0):
+    """
+    Adds whitespace to the element's text and tails so that it gets
+    pretty-printed by tostring().
+    """
+    i = '\n' + level*INDENT
+    if len(elem):
+        if not elem.text or not elem.text.strip():
+            elem.text = i + INDENT
+        for child in elem:
+            _indent(child, level+1)
+        if not child.tail or not child.tail.strip():
+            child.tail = i
+    if level and (not elem.tail or not elem.tail.strip()):
+        elem.tail = i
@@ -10,7 +10,7 @@
 # License:      ctSSL is licensed under the terms of the MIT License.
 #-------------------------------------------------------------------------------
 
-from ctypes import create_string_buffer, sizeof, memmove, byref
+from ctypes import create_string_buffer, sizeof, string_at, byref
 from ctypes import c_char_p, c_void_p, c_int, c_long
 from load_openssl import libcrypto
 from errors import get_openssl_error, BIOError, errcheck_get_error_if_null, \
@@ -139,9 +139,7 @@ def read(self, size):
         read_buffer = create_string_buffer(size)
         size_read = libcrypto.BIO_read(self._bio_struct_p, read_buffer, size)
         # Returning the number of bytes that were actually read
-        final_buffer = create_string_buffer(size_read)
-        memmove(final_buffer, read_buffer, size_read)
-        return final_buffer.raw
+        return string_at(read_buffer, size_read)
 
 
     def write(self, data):
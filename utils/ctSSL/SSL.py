@@ -9,7 +9,7 @@
 # License:      ctSSL is licensed under the terms of the MIT License.
 #-------------------------------------------------------------------------------
 
-from ctypes import create_string_buffer, sizeof, memmove
+from ctypes import create_string_buffer, sizeof, memmove, string_at, c_char
 from ctypes import c_char_p, c_void_p, c_int, c_long
 
 from load_openssl import libssl, OpenSSL_version
@@ -20,6 +20,9 @@
 
 SSL_CTRL_GET_RI_SUPPORT = 76 # SSL_get_secure_renegotiation_support()
 
+HANDSHAKE_RECV_SIZE = 4096 # Minimum size of each recv() during handshakes
+MAX_RECORD_SIZE = 16384 + 2048 + 5 # Biggest possible SSL/TLS record
+
 
 class SSL:
     """
@@ -51,6 +54,10 @@ class SSL:
     @type _pem_passwd_cb: ctypes.CFUNCTYPE
     @ivar _pem_passwd_cb: Callback function used for password protected client
     certificates.
+
+    @type _read_buffer: ctypes.c_char_Array
+    @ivar _read_buffer: Buffer reused by read() to receive the decrypted
+    data. Grows with the biggest size that was requested.
     """
 
     def __init__(self, ssl_ctx):
@@ -67,6 +74,7 @@ def __init__(self, ssl_ctx):
         self._internal_bio = None
         self._network_bio = None
         self._pem_passwd_cb = None
+        self._read_buffer = None
 
         # Create a BIO pair to handle SSL operations
         (internal_bio, network_bio) = BIO.BIOFactory.new_bio_pair()
@@ -135,31 +143,80 @@ def _do_handshake(self):
         @raise socket.timeout:
         @raise socket.error:
         """
-        while True:
-            try:
-                if libssl.SSL_do_handshake(self._ssl_struct_p) == 1:
-                    break # Handshake was successful
-
-            except errors.SSLErrorWantRead:
+        record_tracker = _RecordTracker()
+        while not self.do_handshake_step():
             # OpenSSL is expecting more data from the peer
 
-                # Send available handshake data to the peer
-                client_handshake = ''
-                size_to_read = self._network_bio.ctrl_pending()
-                while size_to_read:
-                    client_handshake += self._network_bio.read(size_to_read)
-                    size_to_read = self._network_bio.ctrl_pending()
-                self._socket.send(client_handshake)
+            # Send available handshake data to the peer
+            client_handshake = self.get_network_data()
+            if client_handshake:
+                self._socket.sendall(client_handshake)
+
+            # Recover the server's response and pass it to the SSL BIO
+            # Ask for the whole record if we know it is bigger than usual,
+            # such as a long certificate chain
+            recv_size = min(max(record_tracker.get_bytes_missing(),
+                                HANDSHAKE_RECV_SIZE), MAX_RECORD_SIZE)
+            server_handshake = self._socket.recv(recv_size)
+            if server_handshake == '': # EOF, handshake failed
+                raise errors.ctSSLUnexpectedEOF(
+                    'Handshake failed: Unexpected EOF')
+            record_tracker.feed(server_handshake)
+            self.put_network_data(server_handshake)
+
+
+    def do_handshake_step(self):
+        """
+        Call SSL_do_handshake() once, without doing any network I/O.
+        Data to be sent to the peer can then be retrieved using
+        get_network_data() and data received from the peer should be passed
+        to put_network_data().
+
+        @rtype: bool
+        @return: True if the handshake is done, False if OpenSSL is expecting
+        more data from the peer.
+
+        @raise ctSSL.errors.SSLError: OpenSSL returned an error at the SSL
+        level.
+        """
+        try:
+            libssl.SSL_do_handshake(self._ssl_struct_p)
+        except errors.SSLErrorWantRead:
+            return False
+        return True
+
+
+    def get_network_data(self):
+        """
+        Retrieve the (encrypted) data OpenSSL wants to send to the peer.
+
+        @rtype: str
+        @return: The data to send to the peer. Can be empty.
+        """
+        data_chunks = []
+        size_to_read = self._network_bio.ctrl_pending()
+        while size_to_read:
+            data_chunks.append(self._network_bio.read(size_to_read))
+            size_to_read = self._network_bio.ctrl_pending()
+        return ''.join(data_chunks)
+
+
+    def put_network_data(self, data):
+        """
+        Pass (encrypted) data received from the peer to OpenSSL.
+
+        @type data: str
+        @param data: The data received from the peer.
+        """
+        self._network_bio.write(data)
 
-                # Recover the server's response and pass it to the SSL BIO
-                server_handshake = self._socket.recv(4096)
-                if server_handshake == '': # EOF, handshake failed
-                    raise errors.ctSSLUnexpectedEOF(
-                        'Handshake failed: Unexpected EOF')
-                self._network_bio.write(server_handshake)
 
-            else:
-                pass
+    def set_connect_state(self):
+        """
+        Prepare the SSL object to work as the client.
+        Directly calls OpenSSL's SSL_set_connect_state().
+        """
+        libssl.SSL_set_connect_state(self._ssl_struct_p)
 
 
     def do_client_handshake(self):
@@ -179,7 +236,7 @@ def do_client_handshake(self):
         @raise socket.error:
         """
         # Perform the handshake as the client
-        libssl.SSL_set_connect_state(self._ssl_struct_p)
+        self.set_connect_state()
         return self._do_handshake()
 
 
@@ -219,42 +276,80 @@ def read(self, size):
         if size == 0:
             return ''
 
-        want_read = True
-        decrypted_data = ''
+        # Reuse the same buffer for all the reads on this connection
+        if self._read_buffer is None or sizeof(self._read_buffer) < size:
+            self._read_buffer = create_string_buffer(size)
+
+        size_read = self._read_into_c_buffer(self._read_buffer, size)
+        # Only copy the bytes that were actually read
+        return string_at(self._read_buffer, size_read)
+
+
+    def read_into(self, buffer, nbytes=0):
+        """
+        Read some data from the SSL connection directly into a writable
+        buffer, like socket.recv_into().
+
+        @type buffer: bytearray
+        @param buffer: Writable buffer to store the decrypted data into.
+
+        @type nbytes: int
+        @param nbytes: The maximum number of bytes to read. If 0 or bigger
+        than the buffer, the size of the buffer is used.
+
+        @rtype: int
+        @return: The number of bytes that were stored into the buffer.
+
+        @raise socket.timeout:
+        @raise socket.error:
+        """
+        if nbytes < 0:
+            raise ValueError('negative buffersize in read_into')
+        nbytes = min(nbytes or len(buffer), len(buffer))
+        if nbytes == 0:
+            return 0
+
+        try: # SSL_read() writes into the caller's memory, no copy needed
+            c_buffer = (c_char * nbytes).from_buffer(buffer)
+        except TypeError:
+            # Python 2 memoryviews don't expose the old buffer interface
+            # from_buffer() needs; go through our own read buffer instead.
+            # Anything else that got here is not a writable buffer.
+            if getattr(buffer, 'readonly', True):
+                raise
+            data = self.read(nbytes)
+            buffer[:len(data)] = data
+            return len(data)
+
+        return self._read_into_c_buffer(c_buffer, nbytes)
+
+
+    def _read_into_c_buffer(self, c_buffer, size):
+        """
+        Read up to size bytes of decrypted data into a ctypes buffer and
+        return the number of bytes that were actually read.
+        """
         encrypted_data = '1'
 
-        while want_read and len(encrypted_data):
+        while len(encrypted_data):
             # Receive the available encrypted data from the other end
             encrypted_data = self._socket.recv(size)
             # Pass that data to the SSL BIO
             self._network_bio.write(encrypted_data)
 
-            while True: # Use SSL_read() to recover the decrypted data
-                try: # Read bytes from the SSL BIO
-                    read_buffer = create_string_buffer(size)
-                    size_read = libssl.SSL_read(self._ssl_struct_p, read_buffer,
-                                                size)
-                    # Keep the number of bytes that were actually read
-                    final_buffer = create_string_buffer(size_read)
-                    memmove(final_buffer, read_buffer, size_read)
-                    decrypted_data += final_buffer.raw
+            try: # Use SSL_read() to recover the decrypted data
+                return libssl.SSL_read(self._ssl_struct_p, c_buffer, size)
 
-                except errors.SSLErrorWantRead as e:
-                    # If we get SSLErrorWantRead, it means that OpenSSL needs
-                    # more data from the peer to finish the read operation
-                    break # Restart the read loop
+            except errors.SSLErrorWantRead as e:
+                # If we get SSLErrorWantRead, it means that OpenSSL needs
+                # more data from the peer to finish the read operation
+                continue # Restart the read loop
 
-                except errors.SSLErrorZeroReturn as e:
-                    # OpenSSL was able to decrypt the message, all done
-                    want_read = False
-                    break
-
-                else:
-                    # OpenSSL was able to decrypt the message, all done
-                    want_read = False
-                    break
+            except errors.SSLErrorZeroReturn as e:
+                # OpenSSL was able to decrypt the message, all done
+                return 0
 
-        return decrypted_data
+        return 0
 
 
     def write(self, data):
@@ -275,14 +370,10 @@ def write(self, data):
                          sizeof(write_buffer) - 1)
 
         # And recover it as an encrypted SSL stream of bytes
-        encrypted_data = ''
-        size_to_read = self._network_bio.ctrl_pending()
-        while size_to_read:
-            encrypted_data += self._network_bio.read(size_to_read)
-            size_to_read = self._network_bio.ctrl_pending()
+        encrypted_data = self.get_network_data()
 
         # Send the encrypted data to the other end
-        self._socket.send(encrypted_data)
+        self._socket.sendall(encrypted_data)
 
 
     def get_secure_renegotiation_support(self):
@@ -315,11 +406,7 @@ def shutdown(self):
         libssl.SSL_shutdown(self._ssl_struct_p)
 
         # Recover the close notify as an encrypted SSL stream of bytes
-        encrypted_data = ''
-        size_to_read = self._network_bio.ctrl_pending()
-        while size_to_read:
-            encrypted_data += self._network_bio.read(size_to_read)
-            size_to_read = self._network_bio.ctrl_pending()
+        encrypted_data = self.get_network_data()
 
         # Send it to the other end, skip socket errors
         # (connection was already closed?)
@@ -438,6 +525,23 @@ def get_peer_certificate(self):
         return cert
     
     
+    def get_peer_cert_chain(self):
+        """
+        Return the certificate chain sent by the peer, starting with the
+        peer's certificate.
+        Directly calls OpenSSL's SSL_get_peer_cert_chain().
+
+        @rtype: [str]
+        @return: The DER-encoded certificates within the peer's chain. Use
+        ctSSL.X509.load_der() to get an X509 object for a certificate.
+
+        @raise ctSSLEmptyValue: OpenSSL returned a NULL pointer, meaning there's
+        no peer certificate chain available for the current connection.
+        """
+        chain_p = libssl.SSL_get_peer_cert_chain(self._ssl_struct_p)
+        return X509.x509_stack_to_der_list(chain_p)
+
+
     def pending(self):
         """
         Obtain number of readable bytes buffered in the SSL object.
@@ -502,6 +606,64 @@ def check_private_key(self):
         libssl.SSL_check_private_key(self._ssl_struct_p)
 
 
+class _RecordTracker:
+    """
+    Follows the SSL/TLS record headers in the data received from the peer, to
+    know how many bytes are still missing to complete the current record.
+    """
+
+    def __init__(self):
+        self._bytes_left = 0 # Still to come in the current record's body
+        self._header = ''    # Beginning of a record header
+
+
+    def feed(self, data):
+        """
+        Update the state of the current record with data received from the
+        peer.
+        """
+        pos = 0
+        while pos < len(data):
+            if self._bytes_left: # Skip the body of the current record
+                size = min(self._bytes_left, len(data) - pos)
+                self._bytes_left -= size
+                pos += size
+                continue
+
+            # Record header
+            header_size = self._get_header_size(self._header + data[pos])
+            size = min(header_size - len(self._header), len(data) - pos)
+            self._header += data[pos:pos+size]
+            pos += size
+
+            if len(self._header) == header_size:
+                if header_size == 2: # SSLv2 record
+                    self._bytes_left = ((ord(self._header[0]) & 0x7f) << 8) \
+                        | ord(self._header[1])
+                else: # Type, version and length
+                    self._bytes_left = (ord(self._header[3]) << 8) \
+                        | ord(self._header[4])
+                self._header = ''
+
+
+    def get_bytes_missing(self):
+        """
+        Return the number of bytes needed to complete the current record,
+        0 if the data received so far ended on a record boundary.
+        """
+        if self._header:
+            header_size = self._get_header_size(self._header)
+            return header_size - len(self._header)
+        return self._bytes_left
+
+
+    @staticmethod
+    def _get_header_size(header):
+        # SSLv2 headers are 2 bytes long and have the high bit set
+        return 2 if ord(header[0]) & 0x80 else 5
+
+
+
 # == CTYPE ERRCHECK CALLBACK(S) ==
 def _errcheck_SSL_default(result, func, arguments):
     """
@@ -526,6 +688,12 @@ def _errcheck_SSL_get_peer_certificate(result, func, arguments):
     return result
 
 
+def _errcheck_SSL_get_peer_cert_chain(result, func, arguments):
+    if result is None:
+        raise errors.ctSSLEmptyValue('No peer certificate chain available.')
+    return result
+
+
 def _errcheck_SSL_get_session(result, func, arguments):
     if result is None:
         raise errors.ctSSLEmptyValue('No session available.')
@@ -603,6 +771,10 @@ def init_SSL_functions():
     libssl.SSL_get_peer_certificate.restype = c_void_p
     libssl.SSL_get_peer_certificate.errcheck =_errcheck_SSL_get_peer_certificate
 
+    libssl.SSL_get_peer_cert_chain.argtypes = [c_void_p]
+    libssl.SSL_get_peer_cert_chain.restype = c_void_p
+    libssl.SSL_get_peer_cert_chain.errcheck = _errcheck_SSL_get_peer_cert_chain
+
     libssl.SSL_pending.argtypes = [c_void_p]
     libssl.SSL_pending.restype = c_int
 
@@ -12,7 +12,7 @@
 from ctypes import create_string_buffer, CFUNCTYPE, memmove
 from ctypes import c_void_p, c_int, c_char_p, c_long
 
-from load_openssl import libssl, OpenSSL_version
+from load_openssl import libssl, libcrypto, OpenSSL_version
 import features_not_available
 from errors import errcheck_get_error_if_eq0, errcheck_get_error_if_null, \
     ctSSLError, OpenSSLError, ctSSLFeatureNotAvailable
@@ -35,6 +35,9 @@ class SSL_CTX:
     @type _pem_passwd_cb: ctypes.CFUNCTYPE
     @ivar _pem_passwd_cb: Callback function used for password protected client
     certificates.
+
+    @type _ssl_version: str
+    @ivar _ssl_version: SSL protocol version the SSL_CTX was created with.
     """
 
     def __init__(self, ssl_version='sslv23'):
@@ -50,6 +53,7 @@ def __init__(self, ssl_version='sslv23'):
         """
         self._ssl_ctx_struct_p = None
         self._pem_passwd_cb = None
+        self._ssl_version = ssl_version
         
         if ssl_version == 'sslv23':
             ssl_version = libssl.SSLv23_method()
@@ -86,6 +90,16 @@ def __del__(self):
             self._ssl_ctx_struct_p = None
 
 
+    def get_ssl_version(self):
+        """
+        Get the SSL protocol version the SSL_CTX was created with.
+
+        @rtype: str
+        @return: 'sslv23', 'sslv2', 'sslv3', 'tlsv1', 'tlsv1_1' or 'tlsv1_2'.
+        """
+        return self._ssl_version
+
+
     def get_ssl_ctx_struct_p(self):
         """
         Get the pointer to the SSL_CTX C struct corresponding to the
@@ -156,6 +170,30 @@ def load_verify_locations(self, cafile):
                                              cafile_buffer, None)
 
 
+    def add_verify_certificates(self, x509_list):
+        """
+        Add CA certificates that were already loaded, for example with
+        ctSSL.X509.load_pem_file(), to the ones used to verify the peer.
+        Unlike load_verify_locations(), nothing has to be parsed again so it
+        is cheap to do for every new SSL_CTX.
+        Directly calls OpenSSL's X509_STORE_add_cert() on the SSL_CTX's
+        X509_STORE.
+
+        @type x509_list: [ctSSL.X509.X509]
+        @param x509_list: The CA certificates.
+        """
+        x509_store_p = libssl.SSL_CTX_get_cert_store(self._ssl_ctx_struct_p)
+        is_error_queued = False
+        for x509 in x509_list:
+            # The store takes its own reference to the certificate
+            if not libcrypto.X509_STORE_add_cert(x509_store_p,
+                                                 x509.get_x509_struct_p()):
+                is_error_queued = True # Certificate was already in the store
+
+        if is_error_queued:
+            libcrypto.ERR_clear_error()
+
+
     def use_certificate_file(self, cert, certform):
         """Directly calls OpenSSL's SSL_CTX_use_certificate_file()."""
         #TODO: Clean error if the file can't be found/opened
@@ -234,6 +272,14 @@ def init_SSL_CTX_functions():
     libssl.SSL_CTX_load_verify_locations.restype = c_int
     libssl.SSL_CTX_load_verify_locations.errcheck = errcheck_get_error_if_eq0
 
+    libssl.SSL_CTX_get_cert_store.argtypes = [c_void_p]
+    libssl.SSL_CTX_get_cert_store.restype = c_void_p
+    libssl.SSL_CTX_get_cert_store.errcheck = errcheck_get_error_if_null
+
+    # Used with SSL_CTX_get_cert_store()
+    libcrypto.X509_STORE_add_cert.argtypes = [c_void_p, c_void_p]
+    libcrypto.X509_STORE_add_cert.restype = c_int
+
     libssl.SSL_CTX_use_certificate_file.argtypes = [c_void_p, c_char_p, c_int]
     libssl.SSL_CTX_use_certificate_file.restype = c_int
     libssl.SSL_CTX_use_certificate_file.errcheck = errcheck_get_error_if_eq0
@@ -12,10 +12,10 @@
 #-------------------------------------------------------------------------------
 
 from ctypes import c_void_p, c_int, c_char_p, c_long
-from ctypes import create_string_buffer, sizeof, pointer, byref
+from ctypes import create_string_buffer, sizeof, pointer, byref, addressof
 from load_openssl import libcrypto
 import BIO
-from errors import ctSSLEmptyValue
+from errors import ctSSLEmptyValue, errcheck_get_error_if_null
 
 MAX_X509_CERT_AS_TXT_SIZE = 16384 # google.fr's certificate is *HUGE*
 
@@ -101,8 +101,17 @@ def get_all_entries(self):
             
             
 class X509:
+    
+    # Values extracted from the text version of the certificate
+    TEXT_FIELDS = ['Version: ', 'Not Before: ', 'Not After : ',
+                   'Public Key Algorithm: ', 'Exponent:',
+                   'Signature Algorithm: ']
+    
     def __init__(self, x509_struct):
         self._x509_struct = x509_struct
+        # A certificate never changes: only print and parse it once
+        self._cert_txt = None
+        self._text_fields = None
 
 
     def __del__(self):
@@ -112,14 +121,36 @@ def __del__(self):
             self._x509_struct = None
 
 
+    def get_x509_struct_p(self):
+        """
+        Get the pointer to the X509 C struct corresponding to the X509 object.
+
+        @rtype: ctypes.c_void_p
+        @return: Pointer to the X509 C struct.
+        """
+        return self._x509_struct
+
+
     def as_text(self):
-        # Print the full certificate to a BIO
-        mem_bio = BIO.BIOFactory.new_mem()
-        libcrypto.X509_print(mem_bio.get_bio_struct_p(), self._x509_struct)
+        if self._cert_txt is None:
+            # Print the full certificate to a BIO
+            mem_bio = BIO.BIOFactory.new_mem()
+            libcrypto.X509_print(mem_bio.get_bio_struct_p(), self._x509_struct)
 
-        # Extract the text from the BIO
-        x509_str = mem_bio.read(MAX_X509_CERT_AS_TXT_SIZE)
-        return x509_str
+            # Extract the text from the BIO
+            self._cert_txt = mem_bio.read(MAX_X509_CERT_AS_TXT_SIZE)
+        return self._cert_txt
+
+
+    def as_der(self):
+        """
+        Get the certificate encoded in DER.
+        Directly calls OpenSSL's i2d_X509().
+
+        @rtype: str
+        @return: The DER-encoded certificate.
+        """
+        return _x509_struct_to_der(self._x509_struct)
 
 
     def get_serial_number(self):
@@ -191,6 +222,7 @@ def get_pubkey_size(self):
 # Obviously prepocessor declarations are not directly available in ctypes.
 # As a (temporary?) h4ck I had to use the text version of the certificate
 # that I get with as_text() and parse it to extract the values myself :(.
+# At least the certificate only gets printed and parsed once.
 
 
     def _extract_cert_value(self, key):
@@ -199,15 +231,17 @@ def _extract_cert_value(self, key):
         corresponding to the given key. H4ck to avoid having to call the
         proper C function because it's defined as a macro.
         """
-        value = None
-        certificate_lines = self.as_text().splitlines()
-        for line in certificate_lines:
-            if key in line:
-                # Extract the value
-                value = line.strip().replace(key , '')
-                break
-
-        return value
+        if self._text_fields is None:
+            # Extract all the TEXT_FIELDS in a single pass
+            self._text_fields = {}
+            for line in self.as_text().splitlines():
+                for field in self.TEXT_FIELDS:
+                    if field in line and field not in self._text_fields:
+                        self._text_fields[field] = \
+                            line.strip().replace(field , '')
+                        break
+
+        return self._text_fields.get(key)
 
     def get_pubkey_modulus_as_text(self):
         cert =  self.as_text()
@@ -253,6 +287,85 @@ def get_signature_as_text(self):
         
 
 
+def load_der(der):
+    """
+    Load a DER-encoded certificate, such as one returned by X509.as_der().
+    Directly calls OpenSSL's d2i_X509().
+
+    @type der: str
+    @param der: The DER-encoded certificate.
+
+    @rtype: ctSSL.X509.X509
+    @return: The certificate.
+
+    @raise ctSSL.errors.OpenSSLError: Not a valid certificate.
+    """
+    der_buffer = create_string_buffer(der, len(der))
+    der_p = c_void_p(addressof(der_buffer))
+    return X509(libcrypto.d2i_X509(None, byref(der_p), len(der)))
+
+
+def x509_stack_to_der_list(x509_stack_p):
+    """
+    Encode the certificates within an OpenSSL STACK_OF(X509), such as the one
+    returned by SSL_get_peer_cert_chain(), in DER. Plain strings are cheap to
+    keep around and to send to other processes; use load_der() to get an
+    X509 object out of the ones that need to be looked at.
+    Directly calls OpenSSL's sk_num(), sk_value() and i2d_X509().
+
+    @type x509_stack_p: ctypes.c_void_p
+    @param x509_stack_p: Pointer to the STACK_OF(X509) C struct.
+
+    @rtype: [str]
+    @return: The DER-encoded certificates, in the order of the stack.
+    """
+    der_list = []
+    for i in xrange(libcrypto.sk_num(x509_stack_p)):
+        x509_struct = libcrypto.sk_value(x509_stack_p, c_int(i))
+        der_list.append(_x509_struct_to_der(x509_struct))
+    return der_list
+
+
+def _x509_struct_to_der(x509_struct):
+    der_len = libcrypto.i2d_X509(x509_struct, None)
+    der_buffer = create_string_buffer(der_len)
+    # i2d_X509() moves the pointer it's given past what it wrote
+    der_p = c_void_p(addressof(der_buffer))
+    libcrypto.i2d_X509(x509_struct, byref(der_p))
+    return der_buffer.raw
+
+
+def load_pem_file(pem_file):
+    """
+    Load all the certificates within a PEM file, such as a bundle of CA
+    certificates.
+    Directly calls OpenSSL's PEM_read_bio_X509() until there's no certificate
+    left.
+
+    @type pem_file: str
+    @param pem_file: Path to the PEM file.
+
+    @rtype: [ctSSL.X509.X509]
+    @return: The certificates, in the order they appear in the file.
+    """
+    mem_bio = BIO.BIOFactory.new_mem()
+    mem_bio.require_manual_free()
+    with open(pem_file) as pem:
+        mem_bio.write(pem.read())
+
+    x509_list = []
+    while True:
+        x509_struct = libcrypto.PEM_read_bio_X509(mem_bio.get_bio_struct_p(),
+                                                  None, None, None)
+        if not x509_struct: # End of the file
+            break
+        x509_list.append(X509(x509_struct))
+
+    # Reaching the end of the file left an error in the queue
+    libcrypto.ERR_clear_error()
+    return x509_list
+
+
 # == CTYPE ERRCHECK CALLBACK(S) ==
 def errcheck_X509_default(result, func, arguments):
     """
@@ -313,6 +426,27 @@ def init_X509_functions():
 
     libcrypto.X509_free.argtypes = [c_void_p]
     libcrypto.X509_free.restype = None
+
+    libcrypto.i2d_X509.argtypes = [c_void_p, c_void_p]
+    libcrypto.i2d_X509.restype = c_int
+
+    libcrypto.d2i_X509.argtypes = [c_void_p, c_void_p, c_long]
+    libcrypto.d2i_X509.restype = c_void_p
+    libcrypto.d2i_X509.errcheck = errcheck_get_error_if_null
+
+    # Used within x509_stack_to_der_list(); sk_X509_xxx() are macros around
+    # these
+    libcrypto.sk_num.argtypes = [c_void_p]
+    libcrypto.sk_num.restype = c_int
+
+    libcrypto.sk_value.argtypes = [c_void_p, c_int]
+    libcrypto.sk_value.restype = c_void_p
+    libcrypto.sk_value.errcheck = errcheck_X509_default
+
+    # Used within load_pem_file()
+    libcrypto.PEM_read_bio_X509.argtypes = [c_void_p, c_void_p, c_void_p,
+                                            c_void_p]
+    libcrypto.PEM_read_bio_X509.restype = c_void_p
     
     # Used within X509_NAME
     libcrypto.X509_NAME_entry_count.argtypes = [c_void_p]
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+# Name:         X509_STORE.py
+# Purpose:      Wrapper around the OpenSSL C functions X509_STORE_xxx(), to
+#               verify certificate chains outside of an SSL handshake.
+#
+# Author:       alban
+#
+# Copyright:    2011 Alban Diquet
+# License:      ctSSL is licensed under the terms of the MIT License.
+#-------------------------------------------------------------------------------
+
+from ctypes import c_int, c_void_p
+from load_openssl import libcrypto
+from errors import errcheck_get_error_if_null, errcheck_get_error_if_eq0
+
+
+class X509_STORE:
+    """
+    Wrapper around the OpenSSL C functions X509_STORE_xxx().
+
+    @type _x509_store_struct_p: ctypes.c_void_p
+    @ivar _x509_store_struct_p: Pointer to the X509_STORE C struct that
+    corresponds to that X509_STORE object.
+    """
+
+    def __init__(self):
+        """
+        Create a new, empty X509_STORE instance.
+        """
+        self._x509_store_struct_p = None
+        self._x509_store_struct_p = libcrypto.X509_STORE_new()
+
+
+    def __del__(self):
+        """
+        Call OpenSSL X509_STORE_free() if a X509_STORE C struct was allocated.
+        """
+        if self._x509_store_struct_p:
+            libcrypto.X509_STORE_free(self._x509_store_struct_p)
+            self._x509_store_struct_p = None
+
+
+    def add_cert(self, x509):
+        """
+        Add a trusted certificate to the store.
+        Directly calls OpenSSL's X509_STORE_add_cert(); the store takes its
+        own reference to the certificate.
+
+        @type x509: ctSSL.X509.X509
+        @param x509: The trusted certificate.
+        """
+        if not libcrypto.X509_STORE_add_cert(self._x509_store_struct_p,
+                                             x509.get_x509_struct_p()):
+            libcrypto.ERR_clear_error() # Certificate was already in the store
+
+
+    def verify_cert(self, x509, untrusted_x509_list=()):
+        """
+        Verify a certificate against the trusted certificates of the store,
+        the same way OpenSSL does during a handshake.
+        Directly calls OpenSSL's X509_verify_cert().
+
+        @type x509: ctSSL.X509.X509
+        @param x509: The certificate to verify.
+
+        @type untrusted_x509_list: [ctSSL.X509.X509]
+        @param untrusted_x509_list: Intermediate certificates that can be used
+        to build the chain, such as the ones sent by the server.
+
+        @rtype: int
+        @return: The verification result, as returned by
+        SSL.get_verify_result(): 0 if the certificate is trusted, or an error
+        code. See ctSSL.X509_V_CODES.
+        """
+        # sk_X509_xxx() are macros around the generic stack functions
+        untrusted_stack_p = libcrypto.sk_new_null()
+        store_ctx_p = None
+        try:
+            for untrusted_x509 in untrusted_x509_list:
+                libcrypto.sk_push(untrusted_stack_p,
+                                  untrusted_x509.get_x509_struct_p())
+
+            store_ctx_p = libcrypto.X509_STORE_CTX_new()
+            libcrypto.X509_STORE_CTX_init(store_ctx_p,
+                                          self._x509_store_struct_p,
+                                          x509.get_x509_struct_p(),
+                                          untrusted_stack_p)
+            if libcrypto.X509_verify_cert(store_ctx_p) != 1:
+                libcrypto.ERR_clear_error()
+            return libcrypto.X509_STORE_CTX_get_error(store_ctx_p)
+
+        finally:
+            if store_ctx_p:
+                libcrypto.X509_STORE_CTX_free(store_ctx_p)
+            # Only frees the stack; the certificates belong to the X509 objects
+            libcrypto.sk_free(untrusted_stack_p)
+
+
+# == CTYPE INIT ==
+def init_X509_STORE_functions():
+    """
+    Tells ctype the argument, return type, and error checking callback of every
+    OpenSSL X509_STORE_xxx() C functions called in this module.
+    """
+    libcrypto.X509_STORE_new.argtypes = []
+    libcrypto.X509_STORE_new.restype = c_void_p
+    libcrypto.X509_STORE_new.errcheck = errcheck_get_error_if_null
+
+    libcrypto.X509_STORE_free.argtypes = [c_void_p]
+    libcrypto.X509_STORE_free.restype = None
+
+    libcrypto.X509_STORE_add_cert.argtypes = [c_void_p, c_void_p]
+    libcrypto.X509_STORE_add_cert.restype = c_int
+
+    libcrypto.X509_STORE_CTX_new.argtypes = []
+    libcrypto.X509_STORE_CTX_new.restype = c_void_p
+    libcrypto.X509_STORE_CTX_new.errcheck = errcheck_get_error_if_null
+
+    libcrypto.X509_STORE_CTX_init.argtypes = [c_void_p, c_void_p, c_void_p,
+                                              c_void_p]
+    libcrypto.X509_STORE_CTX_init.restype = c_int
+    libcrypto.X509_STORE_CTX_init.errcheck = errcheck_get_error_if_eq0
+
+    libcrypto.X509_STORE_CTX_free.argtypes = [c_void_p]
+    libcrypto.X509_STORE_CTX_free.restype = None
+
+    libcrypto.X509_STORE_CTX_get_error.argtypes = [c_void_p]
+    libcrypto.X509_STORE_CTX_get_error.restype = c_int
+
+    libcrypto.X509_verify_cert.argtypes = [c_void_p]
+    libcrypto.X509_verify_cert.restype = c_int
+
+    # Used for the untrusted certificates
+    libcrypto.sk_new_null.argtypes = []
+    libcrypto.sk_new_null.restype = c_void_p
+    libcrypto.sk_new_null.errcheck = errcheck_get_error_if_null
+
+    libcrypto.sk_push.argtypes = [c_void_p, c_void_p]
+    libcrypto.sk_push.restype = c_int
+    libcrypto.sk_push.errcheck = errcheck_get_error_if_eq0
+
+    libcrypto.sk_free.argtypes = [c_void_p]
+    libcrypto.sk_free.restype = None
@@ -11,10 +11,12 @@
 
 from ctypes import c_ulong, c_int, CFUNCTYPE, c_char_p, c_void_p
 from load_openssl import libssl, libcrypto, ctSSLInitError
-import SSL, BIO, SSL_CTX, errors, SSL_SESSION, X509
+import SSL, BIO, SSL_CTX, errors, SSL_SESSION, X509, X509_STORE
 import features_not_available
 
 openSSL_threading = False
+ctSSL_initialized = False
+zlib_initialized = False
 
 
 def ctSSL_initialize(multithreading=False, zlib=False):
@@ -28,8 +30,17 @@ def ctSSL_initialize(multithreading=False, zlib=False):
     
     @type zlib: boolean
     @param zlib: Initialize support for Zlib compression.
-    
+
+    Calling it again once ctSSL is initialized is cheap: only Zlib support
+    gets enabled, if it wasn't already.
     """
+    global ctSSL_initialized, zlib_initialized
+
+    if ctSSL_initialized:
+        if zlib and not zlib_initialized:
+            _zlib_initialize()
+        return
+
     # Initialize multithreading
     multithreading=False    # TODO: Clean start. Disabled for now, causes issues
                             # Might not be required ?
@@ -50,33 +61,44 @@ def ctSSL_initialize(multithreading=False, zlib=False):
     SSL.init_SSL_functions()
     SSL_SESSION.init_SSL_SESSION_functions()
     X509.init_X509_functions()
+    X509_STORE.init_X509_STORE_functions()
     errors.init_ERR_functions()
+    ctSSL_initialized = True
 
-    if zlib: # Enable Zlib compression. Can only be done globally.
-        try:
-            libcrypto.COMP_zlib.argtypes = []
-            libcrypto.COMP_zlib.restype = c_void_p
-    
-            libssl.SSL_COMP_add_compression_method.argtypes = [c_int, c_void_p]
-            libssl.SSL_COMP_add_compression_method.restype = c_int
+    if zlib:
+        _zlib_initialize()
 
-            zlib_comp_p = libcrypto.COMP_zlib()
-            has_zlib = libssl.SSL_COMP_add_compression_method(1, zlib_comp_p)
-        
-        except AttributeError: # OpenSSL is super old and COMP_XX() is not defined ?
-            raise errors.ctSSLFeatureNotAvailable("Could not enable Zlib compression: not supported by the version of the OpenSSL library that was loaded ?")
-        
-        except: # TODO: Check for common errors here and add meaningful error message
-            raise
-            
-        if has_zlib != 0:
-            raise errors.ctSSLFeatureNotAvailable("Could not enable Zlib compression: OpenSSL was not built with Zlib support ?")
+
+def _zlib_initialize():
+    """Enable Zlib compression. Can only be done globally."""
+    global zlib_initialized
+    try:
+        libcrypto.COMP_zlib.argtypes = []
+        libcrypto.COMP_zlib.restype = c_void_p
+
+        libssl.SSL_COMP_add_compression_method.argtypes = [c_int, c_void_p]
+        libssl.SSL_COMP_add_compression_method.restype = c_int
+
+        zlib_comp_p = libcrypto.COMP_zlib()
+        has_zlib = libssl.SSL_COMP_add_compression_method(1, zlib_comp_p)
+    
+    except AttributeError: # OpenSSL is super old and COMP_XX() is not defined ?
+        raise errors.ctSSLFeatureNotAvailable("Could not enable Zlib compression: not supported by the version of the OpenSSL library that was loaded ?")
+    
+    except: # TODO: Check for common errors here and add meaningful error message
+        raise
         
-        features_not_available.ZLIB_NOT_AVAIL = False
+    if has_zlib != 0:
+        raise errors.ctSSLFeatureNotAvailable("Could not enable Zlib compression: OpenSSL was not built with Zlib support ?")
+    
+    features_not_available.ZLIB_NOT_AVAIL = False
+    zlib_initialized = True
 
 
 
 def ctSSL_cleanup():
+    global ctSSL_initialized
+    ctSSL_initialized = False
     libcrypto.EVP_cleanup()
     libcrypto.ERR_free_strings()
 
@@ -22,6 +22,7 @@
 
 
 SSL_OP_NO_TICKET = 0x00004000L # No TLS Session Tickets
+SSL_OP_NO_COMPRESSION = 0x00020000L # Don't offer Zlib even if it's enabled
 SSL_SESS_CACHE_OFF = 0 # No Session Resumption
 
 if not features_not_available.SSL_SECURE_RENEGOTIATION_NOT_AVAIL:
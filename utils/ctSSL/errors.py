@@ -210,6 +210,9 @@ def init_ERR_functions():
     libcrypto.ERR_error_string_n.argtypes = [c_ulong, c_char_p, c_int]
     libcrypto.ERR_error_string_n.restype = c_int
 
+    libcrypto.ERR_clear_error.argtypes = []
+    libcrypto.ERR_clear_error.restype = None
+
     libssl.SSL_get_error.argtypes = [c_void_p, c_int]
     libssl.SSL_get_error.restype = c_int
 
@@ -23,11 +23,22 @@
 #-------------------------------------------------------------------------------
 
 import socket
-from threading import Thread
-from Queue import Queue
+from threading import Thread, Lock
+from Queue import Queue, Empty
 
 RESULT_FORMAT = '   {0:<35} => {1:<35}'
 
+# Number of targets being tested at the same time
+MAX_DISCOVERY_THREADS = 50
+
+# Seconds without any new target after which the generator yields anyway
+IDLE_YIELD_INTERVAL = 1
+
+# Host names resolved so far; the worker processes get the IP addresses
+# within each target tuple, so they never have to resolve them again
+_dns_cache = {}
+_dns_cache_lock = Lock()
+
 def is_target_valid(target, default_port = 443):
     valid_target = None
     
@@ -47,17 +58,28 @@ def is_target_valid(target, default_port = 443):
 
     
 
-def discover_targets(args_target_list, args_command_list, available_commands, main_task_queue):
+def discover_targets(target_iterator, args_command_list, available_commands,
+                     main_task_queue, main_result_queue=None, result_sources=(),
+                     rate_limiter=None):
     """
-    Gets a list of strings "host:port", discards hosts that are not responding
-    to a TCP connection attempt, and fills the main_task_queue with the work
-    to do, defined by args_command_list.
+    Gets strings "host:port" from target_iterator, discards hosts that are not
+    responding to a TCP connection attempt, and fills the main_task_queue with
+    the work to do, defined by args_command_list.
+    Targets are read lazily and tested by a fixed number of threads, so that
+    the work on the first targets can start while the others are being
+    tested.
+    Tasks that already have a result in one of the result_sources (the result
+    cache or the checkpoint journal) are not queued; their result is put in
+    main_result_queue instead.
+    With --skip_discovery, the host names only get resolved; the first
+    connection made by a plugin tells whether the target is up.
+    The test connections go through rate_limiter, if one is given.
+    This is a generator: it yields (target, nb_work_units) for each alive
+    target, once its work units were queued. When no target was found for
+    IDLE_YIELD_INTERVAL seconds, it yields (None, 0) so that the caller can
+    process the results that came in meanwhile.
     """
-    # Create thread pool. One thread per valid target
-    result_queue = Queue()
-    thread_list = []
     socket_timeout = args_command_list.timeout
-    alive_target_list = []
     print''
     
     # If an HTTP CONNECT proxy was specified, we only make sure that the proxy 
@@ -65,7 +87,9 @@ def discover_targets(args_target_list, args_command_list, available_commands, ma
     if args_command_list.https_tunnel:
         (host,port) = is_target_valid(args_command_list.https_tunnel)
         
-        if _test_connect((host,port), socket_timeout) is None: 
+        (ip_addr, error_text) = _test_connect((host,port), socket_timeout,
+                                              rate_limiter=rate_limiter)
+        if ip_addr is None: 
             print RESULT_FORMAT.format(
                 args_command_list.https_tunnel, 
                 'ERROR: Could not connect to proxy, discarding all tasks.')
@@ -75,7 +99,7 @@ def discover_targets(args_target_list, args_command_list, available_commands, ma
                 args_command_list.https_tunnel, 
                 'Proxy OK')
             
-            for target in args_target_list:
+            for target in target_iterator:
                 try:
                     (host,port) = is_target_valid(target)
                 except:
@@ -84,12 +108,11 @@ def discover_targets(args_target_list, args_command_list, available_commands, ma
                 
                 else: # Don't try to connect
                     target = (host, host, port)
-                    alive_target_list.append(target)
                     # Fill the task queue if target is up
-                    for command in available_commands:
-                        if getattr(args_command_list, command):
-                            args = args_command_list.__dict__[command]
-                            main_task_queue.put( (target, command, args) )
+                    nb_work_units = _queue_tasks(
+                        target, args_command_list, available_commands,
+                        main_task_queue, main_result_queue, result_sources)
+                    yield (target, nb_work_units)
             
             
     # No proxy try to connect to all targets
@@ -104,66 +127,190 @@ def discover_targets(args_target_list, args_command_list, available_commands, ma
             default_port = 5222
             test_stattls = test_starttls_xmpp
             test_starttls_args = [args_command_list.xmpp_to]
-            
-        for target in args_target_list:
-            try:
-                (host,port) = is_target_valid(target, default_port)
-            except:
-                print RESULT_FORMAT.format(target, \
-                    'WARNING: Not a valid host/port'
-                    ', discarding corresponding tasks.')
-            
-            else: # Host and port are correct, let's try to connect
-                worker = \
-                    Thread(target=_test_connect, 
-                           args=(
-                                 (host,port), 
-                                 socket_timeout, 
-                                 result_queue, 
-                                 test_stattls,
-                                 test_starttls_args))
-                worker.start()
-                thread_list.append(worker)
-    
+
+        # The job queue is bounded so that we don't read the whole list of
+        # targets in memory at once
+        job_queue = Queue(MAX_DISCOVERY_THREADS * 2)
+        result_queue = Queue()
+
+        thread_list = [Thread(target=_feed_targets,
+                              args=(target_iterator, default_port, job_queue,
+                                    result_queue, MAX_DISCOVERY_THREADS))]
+        for i in xrange(MAX_DISCOVERY_THREADS):
+            thread_list.append(
+                Thread(target=_discovery_work_function,
+                       args=(job_queue, result_queue, socket_timeout,
+                             test_stattls, test_starttls_args,
+                             args_command_list.skip_discovery, rate_limiter)))
+        for worker in thread_list:
+            worker.daemon = True # Don't hang on exit if the main thread fails
+            worker.start()
+
         # Grab each result and fill the task queue so that processes can start working
-        for i in xrange(len(thread_list)):
-            (host_addr, ip_addr, error_string) = result_queue.get()
-            (host,port) = host_addr
-    
-            if error_string is not '': # An error occurred
-                print RESULT_FORMAT.format(host + ':' + str(port), error_string)
+        nb_active_threads = MAX_DISCOVERY_THREADS
+        while nb_active_threads:
+            try:
+                result = result_queue.get(timeout=IDLE_YIELD_INTERVAL)
+            except Empty:
+                yield (None, 0)
+                continue
+
+            if result is None: # One thread was done
+                nb_active_threads -= 1
+                continue
+
+            (target_str, target, error_text) = result
+            if error_text: # An error occurred
+                print RESULT_FORMAT.format(target_str, error_text)
             else:
-                (ip, port) = ip_addr
-                print RESULT_FORMAT.format(host + ':' + str(port), ip + ':' + str(port))
-                target = (host, ip, port) # Keep the IP address we found
-                alive_target_list.append(target)
+                (host, ip, port) = target
+                print RESULT_FORMAT.format(target_str, ip + ':' + str(port))
                 # Fill the task queue if target is up
-                for command in available_commands:
-                    if getattr(args_command_list, command):
-                        args = args_command_list.__dict__[command]
-                        main_task_queue.put( (target, command, args) )
-    
-            result_queue.task_done()
+                nb_work_units = _queue_tasks(
+                    target, args_command_list, available_commands,
+                    main_task_queue, main_result_queue, result_sources)
+                yield (target, nb_work_units)
     
         # Make sure all the worker threads had time to terminate
         [worker.join() for worker in thread_list]
-        result_queue.join()
 
-    return alive_target_list
 
+def _feed_targets(target_iterator, default_port, job_queue, result_queue,
+                  nb_threads):
+    """
+    Reads the targets and queues the valid ones for the discovery threads,
+    then queues one sentinel per discovery thread.
+    """
+    try:
+        for target in target_iterator:
+            try:
+                (host,port) = is_target_valid(target, default_port)
+            except:
+                result_queue.put( (target, None, 'WARNING: Not a valid host/port'
+                                   ', discarding corresponding tasks.') )
+            else:
+                job_queue.put( (host,port) )
+    finally:
+        for i in xrange(nb_threads):
+            job_queue.put(None)
 
-def _test_connect(target, timeout, out_q=None, test_starttls=None, test_starttls_args=()):
+
+def _discovery_work_function(job_queue, result_queue, timeout, test_starttls,
+                             test_starttls_args, skip_connect=False,
+                             rate_limiter=None):
+    """
+    Resolves and connects to each (host, port) from job_queue and puts the
+    outcome in result_queue, until it gets a None sentinel.
+    If skip_connect is True, the targets are only resolved.
+    """
+    while True:
+        job = job_queue.get()
+        if job is None: # No more targets
+            result_queue.put(None)
+            break
+
+        (host,port) = job
+        target_str = host + ':' + str(port)
+        target = None
+        try:
+            resolved_ip = _resolve_host(host)
+        except socket.error: # Could not resolve the host
+            error_text = 'WARNING: Could not connect, discarding corresponding tasks.'
+        else:
+            if skip_connect: # The plugins will find out if the host is up
+                error_text = ''
+                target = (host, resolved_ip, port)
+            else:
+                (ip_addr, error_text) = _test_connect(
+                    (host,port), timeout, test_starttls, test_starttls_args,
+                    resolved_ip, rate_limiter)
+                if not error_text:
+                    target = (host, ip_addr[0], port) # Keep the IP address we found
+        result_queue.put( (target_str, target, error_text) )
+
+
+def _queue_tasks(target, args_command_list, available_commands,
+                 main_task_queue, main_result_queue, result_sources):
+    """
+    Queues the tasks to perform on the target, or directly queues their
+    result if it can be found in one of the result sources.
+    A work unit is a (target, [(command, args), ...]) tuple. With
+    --group_by_target, all the commands for the target go in the same work
+    unit; otherwise each command gets its own.
+    Returns the number of work units that were queued.
+    """
+    task_list = []
+    for command in available_commands:
+        if getattr(args_command_list, command):
+            args = args_command_list.__dict__[command]
+            for result_source in result_sources:
+                plugin_result = result_source.get(target, command, args)
+                if plugin_result:
+                    main_result_queue.put( (target, command, plugin_result) )
+                    break
+            else: # Not found anywhere, has to be scanned
+                task_list.append( (command, args) )
+
+    # Plugins with a higher priority go last within a work unit
+    task_list.sort(key=lambda task: \
+        available_commands[task[0]].PLUGIN_PRIORITY)
+
+    if not task_list:
+        return 0
+
+    if args_command_list.group_by_target:
+        main_task_queue.put( (target, task_list) )
+        return 1
+
+    for task in task_list:
+        main_task_queue.put( (target, [task]) )
+    return len(task_list)
+
+
+def _resolve_host(host):
+    """
+    Returns the IPv4 address of the host, the same address family as the
+    sockets we use to connect. Each host name only gets resolved once; if it
+    could not be resolved, the same exception gets raised again.
+    """
+    with _dns_cache_lock:
+        ip_addr = _dns_cache.get(host)
+
+    if ip_addr is None:
+        try:
+            addr_info = socket.getaddrinfo(host, None, socket.AF_INET,
+                                           socket.SOCK_STREAM)
+            ip_addr = addr_info[0][4][0]
+        except socket.error as e:
+            ip_addr = e
+        with _dns_cache_lock:
+            _dns_cache[host] = ip_addr
+
+    if isinstance(ip_addr, Exception):
+        raise ip_addr
+    return ip_addr
+
+
+def _test_connect(target, timeout, test_starttls=None, test_starttls_args=(),
+                  resolved_ip=None, rate_limiter=None):
     """
-    Try to connect to the given target=(host,port) and put the result in out_q.
+    Try to connect to the given target=(host,port).
+    If the host name was already resolved, resolved_ip is used to connect.
+    If a rate_limiter is given, waits for our turn before connecting.
+    Returns the (ip, port) we connected to, or None, and an error message
+    that is empty if everything went fine.
     """
     (host,port) = target
+    if rate_limiter: # Discovery counts against the connection rate limits
+        rate_limiter.acquire((host, resolved_ip or host, port))
+
     s = socket.socket()
     s.settimeout(timeout)
     error_text = ''
     ip_addr = None
 
     try:
-        s.connect((host, port))
+        s.connect((resolved_ip or host, port))
         # Host is up => keep the IP address we actually connected to
         ip_addr = s.getpeername()
         if test_starttls:
@@ -180,10 +327,8 @@ def _test_connect(target, timeout, out_q=None, test_starttls=None, test_starttls
 
     finally:
         s.close()
-        if out_q:
-            out_q.put( (target, ip_addr, error_text) )
 
-    return ip_addr
+    return (ip_addr, error_text)
 
 
 def test_starttls_smtp(s, host): 
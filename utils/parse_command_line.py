@@ -23,9 +23,11 @@
 
 from optparse import OptionParser, OptionGroup
 from multiprocessing import Manager
+from itertools import chain
 import platform
 
 from discover_targets import is_target_valid
+from ConnectionRateLimiter import ConnectionRateLimiter
 
 PARSING_ERROR_FORMAT = '   Command line error: {0}\n   Use -h for help.'
 
@@ -76,6 +78,14 @@ def create_command_line_parser(available_plugins, prog_version, timeout):
         dest='xml_file',
         default=None)
 
+    # JSON Lines output
+    parser.add_option(
+        '--json_out',
+        help= ('Writes the scan results to the file JSON_FILE as soon as they '
+               'are available, one JSON object per line.'),
+        dest='json_file',
+        default=None)
+
     # Read targets from input file
     parser.add_option(
         '--targets_in',
@@ -83,6 +93,73 @@ def create_command_line_parser(available_plugins, prog_version, timeout):
         dest='targets_in',
         default=None)
 
+    # Result cache
+    parser.add_option(
+        '--cache',
+        help= (
+            'Stores the results of the scan in the SQLite database CACHE_FILE, '
+            'and reuses results already stored there instead of scanning the '
+            'target server(s) again. Results are only reused if the scan '
+            'settings were the same.'),
+        dest='cache_file',
+        default=None)
+
+    parser.add_option(
+        '--cache_ttl',
+        help= (
+            'Sets the number of seconds after which a result stored in the '
+            'cache has to be scanned again. Default is 86400s (24h).'),
+        type='int',
+        dest='cache_ttl',
+        default=86400)
+
+    # Distributed scans
+    parser.add_option(
+        '--coordinator',
+        help= (
+            'Listens on COORDINATOR (\'host:port\') for agents to connect, '
+            'and lets them process some of the tasks. Their results are '
+            'merged with the ones from this host. Requires --authkey.'),
+        dest='coordinator',
+        default=None)
+
+    parser.add_option(
+        '--agent',
+        help= (
+            'Runs as an agent: connects to the coordinator at AGENT '
+            '(\'host:port\') and processes its tasks, using its scan '
+            'settings, until it is done. No targets should be given. '
+            'Requires --authkey.'),
+        dest='agent',
+        default=None)
+
+    parser.add_option(
+        '--authkey',
+        help= (
+            'Sets the secret shared between the coordinator and its agents.'),
+        dest='authkey',
+        default=None)
+
+    # Checkpoint journal
+    parser.add_option(
+        '--checkpoint',
+        help= (
+            'Writes each result to the file CHECKPOINT_FILE as soon as it is '
+            'available, so that the scan can be resumed with --resume if it '
+            'gets interrupted.'),
+        dest='checkpoint_file',
+        default=None)
+
+    parser.add_option(
+        '--resume',
+        help= (
+            'Resumes an interrupted scan: the results already in the '
+            '--checkpoint file are reused and only the missing tasks are '
+            'performed. The scan settings have to be the same.'),
+        action='store_true',
+        dest='resume',
+        default=False)
+
     # Timeout
     parser.add_option(
         '--timeout',
@@ -93,7 +170,59 @@ def create_command_line_parser(available_plugins, prog_version, timeout):
         dest='timeout',
         default=timeout)
 
-    
+    # Number of processes
+    parser.add_option(
+        '--nb_processes',
+        help= (
+            'Sets the maximum number of processes used to run the scans. '
+            'Default is one process per CPU, with a minimum of 5. The actual '
+            'number of processes also depends on the number of tasks left.'),
+        type='int',
+        dest='nb_processes',
+        default=None)
+
+    # Connection rate limits
+    parser.add_option(
+        '--max_rate',
+        help= (
+            'Sets the maximum number of new connections per second to all the '
+            'target servers, across all processes and threads.'),
+        type='float',
+        dest='max_rate',
+        default=None)
+
+    parser.add_option(
+        '--max_rate_per_target',
+        help= (
+            'Sets the maximum number of new connections per second to a single '
+            'target server.'),
+        type='float',
+        dest='max_rate_per_target',
+        default=None)
+
+    # Scheduling
+    parser.add_option(
+        '--group_by_target',
+        help= (
+            'Processes all the commands for a given target server within the '
+            'same process, instead of spreading them across all the '
+            'processes. What a command learns about the server can then be '
+            'reused by the following commands.'),
+        action='store_true',
+        dest='group_by_target',
+        default=False)
+
+    parser.add_option(
+        '--skip_discovery',
+        help= (
+            'Does not test whether the target server(s) are up before '
+            'scanning them. The first connection made by a plugin is used '
+            'instead, and the remaining commands for a target that could not '
+            'be reached are cancelled. Implies --group_by_target.'),
+        action='store_true',
+        dest='skip_discovery',
+        default=False)
+
     # HTTP CONNECT Proxy
     parser.add_option(
         '--https_tunnel',
@@ -182,23 +311,29 @@ def parse_command_line(parser):
 
     (args_command_list, args_target_list) = parser.parse_args()
 
-    # Handle the --targets_in command line and fill args_target_list
+    # Handle the --targets_in command line: the file is read lazily, as the
+    # targets get scanned
     if args_command_list.targets_in:
         if args_target_list:
             print "   ERROR: Cannot use --targets_list and specify targets within the command line."
             return
             
-        try:
-            with open(args_command_list.targets_in) as f:
-                for target in f.readlines():
-                    if target.strip(): # Ignore empty lines
-                        if not target.startswith('#'): # Ignore comment lines
-                            args_target_list.append(target.strip())
+        target_iterator = _read_targets_file(args_command_list.targets_in)
+        try: # Make sure there's at least one target in the file
+            first_target = target_iterator.next()
         except IOError, e:
             print "   ERROR: Can't read targets from input file '%s'." %  args_command_list.targets_in
             return
+        except StopIteration:
+            return
+        args_target_list = chain([first_target], target_iterator)
 
-    if args_target_list == []:
+    elif args_command_list.agent:
+        if args_target_list: # Agents get their targets from the coordinator
+            print "   ERROR: Cannot use --agent and specify targets within the command line."
+            return
+
+    elif args_target_list == []:
         return
 
     # Handle the --regular command line parameter as a shortcut
@@ -219,6 +354,17 @@ def parse_command_line(parser):
             
     return (args_command_list, args_target_list)
 
+def _read_targets_file(targets_file):
+    """
+    Generator returning the targets from the file, one at a time.
+    """
+    with open(targets_file) as f:
+        for target in f:
+            if target.strip(): # Ignore empty lines
+                if not target.startswith('#'): # Ignore comment lines
+                    yield target.strip()
+
+
 def process_parsing_results(args_command_list):
     
     shared_settings = {}
@@ -252,6 +398,68 @@ def process_parsing_results(args_command_list):
         print PARSING_ERROR_FORMAT.format('--keyform should be DER or PEM.')
         return
 
+    # Number of processes
+    if args_command_list.nb_processes is not None \
+        and args_command_list.nb_processes < 1:
+        print PARSING_ERROR_FORMAT.format('--nb_processes should be at least 1.')
+        return
+
+    # Result cache
+    if args_command_list.cache_ttl < 0:
+        print PARSING_ERROR_FORMAT.format('--cache_ttl should be positive.')
+        return
+
+    # Distributed scans
+    if args_command_list.coordinator and args_command_list.agent:
+        print PARSING_ERROR_FORMAT.format(
+            'Cannot have --coordinator and --agent at the same time.')
+        return
+
+    for (option, address) in [('--coordinator', args_command_list.coordinator),
+                              ('--agent', args_command_list.agent)]:
+        if address is None:
+            continue
+        if args_command_list.cert or args_command_list.key:
+            # The files would only be on one host
+            print PARSING_ERROR_FORMAT.format(
+                'Client certificates cannot be used with ' + option + ': the '
+                'agents cannot read the coordinator\'s files.')
+            return
+        if not args_command_list.authkey:
+            print PARSING_ERROR_FORMAT.format(option + ' requires --authkey.')
+            return
+        try:
+            (host, port) = is_target_valid(address, None)
+        except ValueError:
+            port = None
+        if port is None:
+            print PARSING_ERROR_FORMAT.format(
+                'Not a valid host:port for ' + option + '.')
+            return
+
+    # Checkpoint journal
+    if args_command_list.resume and not args_command_list.checkpoint_file:
+        print PARSING_ERROR_FORMAT.format('--resume requires --checkpoint.')
+        return
+
+    # Connection rate limits
+    for (option, rate) in [('--max_rate', args_command_list.max_rate),
+            ('--max_rate_per_target', args_command_list.max_rate_per_target)]:
+        if rate is not None and rate <= 0:
+            print PARSING_ERROR_FORMAT.format(option + ' should be positive.')
+            return
+
+    # Cancelling the commands for an unreachable target only works if they
+    # are all processed together
+    if args_command_list.skip_discovery:
+        args_command_list.group_by_target = True
+
+    if args_command_list.max_rate or args_command_list.max_rate_per_target:
+        shared_settings['rate_limiter'] = ConnectionRateLimiter(
+            args_command_list.max_rate, args_command_list.max_rate_per_target)
+    else:
+        shared_settings['rate_limiter'] = None
+
         
     # HTTP CONNECT proxy
     if args_command_list.https_tunnel: